@@ -0,0 +1,327 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+from datetime import datetime
+import numpy as np
+
+from similarity_calculator import (
+    select_top_k, retrieval, batch_retrieval, search_normalized, l2_normalize, batch_distance,
+    load_features_from_folder, get_file_paths, map_result_paths, process_query, clear_database_cache, get_database
+)
+
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000]
+
+
+def time_call(func, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def full_sort(result):
+    # 原实现: 对整个距离矩阵分别做argsort和sort
+    return np.argsort(result, axis=1), np.sort(result, axis=1)
+
+
+class SyntheticStepPaths:
+    """长度为n的STEP路径序列，按需生成，千万级规模时不占用内存"""
+
+    def __init__(self, folder, n):
+        self.folder = folder
+        self.n = n
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        i = int(i)
+        if not 0 <= i < self.n:
+            raise IndexError(i)
+        return os.path.join(self.folder, f'class{i % 100}_{i:08d}.step')
+
+
+class SyntheticLibrary:
+    """合成的特征库: 单个特征文件(分块写入，可到千万级)，以及规模较小时的特征目录和空STEP文件"""
+
+    def __init__(self, root, n, dim, folder_max=20000, seed=0, chunk_rows=262144):
+        self.root = root
+        self.n = n
+        self.dim = dim
+        self.database_file = os.path.join(root, 'database.npy')
+        self.feature_folder = None
+        self.step_folder = None
+        # STEP路径只用于结果映射，不需要真实文件
+        self.step_paths = SyntheticStepPaths(os.path.join(root, 'steps'), n)
+
+        rng = np.random.default_rng(seed)
+        matrix = np.lib.format.open_memmap(self.database_file, mode='w+', dtype=np.float32, shape=(n, dim))
+        for start in range(0, n, chunk_rows):
+            rows = min(chunk_rows, n - start)
+            matrix[start:start + rows] = rng.standard_normal((rows, dim), dtype=np.float32)
+        matrix.flush()
+        self.queries_source = np.asarray(matrix[:min(n, 1000)]).copy()
+        del matrix
+
+        if n <= folder_max:
+            self.feature_folder = os.path.join(root, 'features')
+            self.step_folder = os.path.join(root, 'steps')
+            os.makedirs(self.feature_folder)
+            os.makedirs(self.step_folder)
+            database = np.load(self.database_file, mmap_mode='r')
+            for i, path in enumerate(self.step_paths):
+                stem = os.path.splitext(os.path.basename(path))[0]
+                np.save(os.path.join(self.feature_folder, stem + '.npy'), np.asarray(database[i:i + 1]))
+                open(path, 'wb').close()
+
+    def queries(self, count, seed=1):
+        rng = np.random.default_rng(seed)
+        base = self.queries_source[rng.integers(len(self.queries_source), size=count)]
+        return base + 0.05 * rng.standard_normal(base.shape, dtype=np.float32)
+
+
+def bench_pipeline(n, dim=128, queries=1, k=8, repeat=3, folder_max=20000, workdir=None):
+    """按阶段计时: 加载、归一化、距离、排序、路径映射，以及process_query端到端"""
+    root = tempfile.mkdtemp(prefix=f'cad_bench_{n}_', dir=workdir)
+    try:
+        library = SyntheticLibrary(root, n, dim, folder_max)
+        x = library.queries(queries)
+        stages = {}
+
+        # 与常驻数据库一致使用内存映射，不把整个矩阵读入或复制到内存，千万级规模也可运行
+        stages['load_mmap'] = time_call(lambda: np.load(library.database_file, mmap_mode='r'), repeat)
+        if library.feature_folder:
+            stages['load_folder'] = time_call(lambda: load_features_from_folder(library.feature_folder), repeat)
+
+        y = np.load(library.database_file, mmap_mode='r')
+
+        def row_scale():
+            # 与FeatureDatabase相同: 归一化表示为每行的缩放系数
+            return 1 / np.sqrt(np.einsum('ij,ij->i', y, y))
+
+        stages['normalize'] = time_call(row_scale, repeat)
+        y_scale = row_scale().astype(np.float32)
+        y_sq = np.einsum('ij,ij->i', y, y) * y_scale * y_scale
+        xn = l2_normalize(x)
+
+        stages['distance'] = time_call(lambda: batch_distance(xn, y, y_sq, y_scale=y_scale), repeat)
+        distances = batch_distance(xn, y, y_sq, y_scale=y_scale)
+        stages['sort_full'] = time_call(lambda: full_sort(distances), repeat)
+        stages['sort_top_k'] = time_call(lambda: select_top_k(distances, k), repeat)
+
+        index, score = select_top_k(distances, k)
+        stages['path_mapping'] = time_call(
+            lambda: [map_result_paths(i, s, library.step_paths) for i, s in zip(index, score)], repeat)
+        if library.step_folder:
+            stages['list_step_files'] = time_call(lambda: get_file_paths(library.step_folder), repeat)
+
+        def query():
+            if library.step_folder:
+                return process_query(x[:1], library.database_file, library.step_folder, True, k=k)
+            # 规模较大时没有真实的STEP目录，按process_query的流程映射到合成路径
+            database = get_database(library.database_file, True)
+            index, score = database.search(x[:1], k)
+            return map_result_paths(index[0], score[0], library.step_paths)
+
+        def cold_query():
+            clear_database_cache()
+            return query()
+
+        assert len(query()[0]) == min(k, n)
+        stages['process_query_cold'] = time_call(cold_query, repeat)
+        stages['process_query_warm'] = time_call(query, repeat)
+        clear_database_cache()
+        return {'n': n, 'dim': dim, 'queries': queries, 'k': k, 'stages': stages}
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def bench_top_k(sizes, k=8, repeat=5, seed=0):
+    rng = np.random.default_rng(seed)
+    rows = []
+    for n in sizes:
+        result = rng.random((1, n))
+        full = time_call(lambda: full_sort(result), repeat)
+        partial = time_call(lambda: select_top_k(result, k), repeat)
+
+        # 校验前k个结果与全排序一致
+        expected = np.sort(result, axis=1)[:, :k]
+        _, got = select_top_k(result, k)
+        assert np.allclose(expected, got)
+
+        rows.append({'n': n, 'k': k, 'stages': {'sort_full': full, 'sort_top_k': partial}})
+    return rows
+
+
+def bench_batch(n, dim=128, queries=100, k=8, repeat=3, seed=0):
+    rng = np.random.default_rng(seed)
+    y = rng.standard_normal((n, dim))
+    x = rng.standard_normal((queries, dim))
+
+    # 逐条调用retrieval与批量检索对比
+    loop = time_call(lambda: [retrieval(x[i:i + 1], y, k) for i in range(queries)], repeat)
+    batch = time_call(lambda: batch_retrieval(x, y, k), repeat)
+
+    expected = np.vstack([retrieval(x[i:i + 1], y, k)[0] for i in range(queries)])
+    got, _ = batch_retrieval(x, y, k)
+    agreement = float((expected[:, 0] == got[:, 0]).mean())
+    return {'n': n, 'dim': dim, 'queries': queries, 'k': k,
+            'stages': {'query_loop': loop, 'query_batch': batch}, 'top1_agreement': agreement}
+
+
+def bench_ivf(n, dim=128, queries=100, k=8, nprobes=(1, 4, 8, 16, 32), seed=0):
+    from ivf_index import IVFIndex, recall_at_k
+
+    rng = np.random.default_rng(seed)
+    # 带聚类结构的合成数据，更接近真实特征分布
+    centers = rng.standard_normal((max(n // 500, 8), dim))
+    y = (centers[rng.integers(len(centers), size=n)] + 0.3 * rng.standard_normal((n, dim))).astype(np.float32)
+    x = y[rng.choice(n, queries, replace=False)] + 0.05 * rng.standard_normal((queries, dim)).astype(np.float32)
+    y = l2_normalize(y)
+
+    start = time.perf_counter()
+    index = IVFIndex.build(y)
+    build_time = time.perf_counter() - start
+
+    y_sq = (y * y).sum(axis=1)
+    exact_time = time_call(lambda: search_normalized(x, y, y_sq, k), 1) / queries
+    exact, _ = search_normalized(x, y, y_sq, k)
+
+    probes = []
+    for nprobe in nprobes:
+        latency = time_call(lambda: index.search(x, k, nprobe), 1) / queries
+        approx, _ = index.search(x, k, nprobe)
+        probes.append({'nprobe': nprobe, 'latency': latency, 'recall': recall_at_k(exact, approx)})
+    return {'n': n, 'dim': dim, 'k': k, 'n_lists': len(index.centroids),
+            'stages': {'ivf_build': build_time, 'exact_per_query': exact_time}, 'probes': probes}
+
+
+def bench_quantization(n, dim=128, queries=100, k=8, seed=0):
+    from ivf_index import recall_at_k
+    from similarity_calculator import FeatureDatabase
+
+    rng = np.random.default_rng(seed)
+    y = rng.standard_normal((n, dim)).astype(np.float32)
+    x = y[rng.choice(n, queries, replace=False)] + 0.1 * rng.standard_normal((queries, dim)).astype(np.float32)
+
+    exact = None
+    modes = []
+    for mode in (None, 'float16', 'int8'):
+        database = FeatureDatabase.from_array(y, quantization=mode)
+        latency = time_call(lambda: database.search(x, k), 1) / queries
+        index, _ = database.search(x, k)
+        if exact is None:
+            exact = index
+        modes.append({'mode': mode or 'float32', 'bytes': database.nbytes, 'latency': latency,
+                      'recall': recall_at_k(exact, index)})
+    return {'n': n, 'dim': dim, 'k': k, 'modes': modes}
+
+
+def environment_info():
+    return {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def compare_with_baseline(report, baseline, threshold=1.2):
+    """逐阶段与基线结果比较，返回超过阈值的回归项"""
+    previous = {(item['suite'], item['n']): item.get('stages', {}) for item in baseline.get('results', [])}
+    regressions = []
+    for item in report['results']:
+        base_stages = previous.get((item['suite'], item['n']))
+        if not base_stages:
+            continue
+        for stage, seconds in item.get('stages', {}).items():
+            base = base_stages.get(stage)
+            if base and seconds / base > threshold:
+                regressions.append({'suite': item['suite'], 'n': item['n'], 'stage': stage,
+                                    'baseline': base, 'current': seconds, 'ratio': seconds / base})
+    return regressions
+
+
+def print_results(report):
+    # 可读的摘要输出到stderr，stdout留给JSON
+    for item in report['results']:
+        print(f"[{item['suite']}] N={item['n']}", file=sys.stderr)
+        for stage, seconds in item.get('stages', {}).items():
+            print(f"    {stage:<22} {seconds * 1000:>12.3f} ms", file=sys.stderr)
+        for probe in item.get('probes', []):
+            print(f"    nprobe={probe['nprobe']:<4} {probe['latency'] * 1000:>10.3f} ms/查询"
+                  f"  recall@k={probe['recall']:.3f}", file=sys.stderr)
+        for mode in item.get('modes', []):
+            print(f"    {mode['mode']:<8} {mode['bytes'] / 2 ** 20:>10.1f} MB {mode['latency'] * 1000:>10.3f} ms/查询"
+                  f"  recall@k={mode['recall']:.3f}", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="检索流程性能测试")
+    parser.add_argument('suites', nargs='*', default=['pipeline'],
+                        choices=['pipeline', 'topk', 'batch', 'ivf', 'quantization'],
+                        help="要运行的测试项，默认只运行pipeline")
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help="数据库规模(向量数)，支持1k到10M")
+    parser.add_argument('--dim', type=int, default=128)
+    parser.add_argument('--k', type=int, default=8)
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--folder-max', type=int, default=20000,
+                        help="不超过该规模时额外生成逐文件特征目录和STEP文件")
+    parser.add_argument('--workdir', default=None, help="合成数据的临时目录")
+    parser.add_argument('--output', default=None, help="JSON结果输出文件，默认输出到stdout")
+    parser.add_argument('--baseline', default=None, help="用于对比的基线JSON文件")
+    parser.add_argument('--threshold', type=float, default=1.2, help="判定为性能回归的耗时比例")
+    args = parser.parse_args()
+
+    report = {'environment': environment_info(), 'args': vars(args), 'results': []}
+    for suite in args.suites:
+        for n in args.sizes:
+            print(f"运行 {suite} N={n} ...", file=sys.stderr)
+            if suite == 'pipeline':
+                item = bench_pipeline(n, args.dim, 1, args.k, args.repeat, args.folder_max, args.workdir)
+            elif suite == 'topk':
+                item = bench_top_k([n], args.k, args.repeat)[0]
+            elif suite == 'batch':
+                item = bench_batch(n, args.dim, args.queries, args.k, args.repeat)
+            elif suite == 'ivf':
+                item = bench_ivf(n, args.dim, args.queries, args.k)
+            else:
+                item = bench_quantization(n, args.dim, args.queries, args.k)
+            item['suite'] = suite
+            report['results'].append(item)
+
+    print_results(report)
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        report['regressions'] = compare_with_baseline(report, baseline, args.threshold)
+        for item in report['regressions']:
+            print(f"性能回归: [{item['suite']}] N={item['n']} {item['stage']} "
+                  f"{item['baseline'] * 1000:.3f} ms -> {item['current'] * 1000:.3f} ms ({item['ratio']:.2f}x)",
+                  file=sys.stderr)
+        exit_code = 1 if report['regressions'] else 0
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    else:
+        json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
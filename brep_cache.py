@@ -0,0 +1,320 @@
+"""STEP模型的二进制BRep磁盘缓存
+
+第一次读取STEP文件时转换为OCC原生的二进制BRep格式(BinTools)，名称和颜色另存为json，
+之后直接读取二进制文件，跳过STEP文本解析。
+缓存可按细节层次(MESH_LEVELS)保存预先剖分好的三角网格，显示时不再重新剖分。
+
+预热整个检索目录:
+    python brep_cache.py warm steps/ --workers 4 --levels coarse fine
+"""
+import os
+import sys
+import json
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from OCC.Core.TopoDS import TopoDS_Shape, TopoDS_Compound, TopoDS_Iterator
+from OCC.Core.BRep import BRep_Builder
+from OCC.Core.BinTools import bintools
+from OCC.Core.BRepTools import breptools
+from OCC.Core.BRepMesh import BRepMesh_IncrementalMesh
+from OCC.Core.Quantity import Quantity_Color, Quantity_TOC_RGB
+
+from similarity_calculator import get_file_paths
+
+CACHE_VERSION = 1
+BREP_SUFFIX = '.brep'
+META_SUFFIX = '.json'
+
+# 细节层次: (相对线性偏差, 角度偏差/弧度)
+# coarse用于结果缩略图，medium用于报告截图，fine用于主视图
+MESH_LEVELS = {
+    'coarse': (0.02, 0.8),
+    'medium': (0.005, 0.5),
+    'fine': (0.001, 0.35),
+}
+
+
+def default_cache_dir():
+    return os.path.join(os.path.expanduser("~"), "cad_temp", "brep_cache")
+
+
+def cache_key(step_path, level=None):
+    # 路径、大小和修改时间任一变化都会得到新的缓存项，每个细节层次单独一个文件
+    stat = os.stat(step_path)
+    text = f"{os.path.abspath(step_path)}|{stat.st_size}|{stat.st_mtime_ns}|{CACHE_VERSION}"
+    key = hashlib.sha1(text.encode('utf-8')).hexdigest()
+    return f"{key}.{level}" if level else key
+
+
+def color_to_list(color):
+    if color is None:
+        return None
+    return [color.Red(), color.Green(), color.Blue()]
+
+
+def list_to_color(values):
+    if values is None:
+        return None
+    return Quantity_Color(values[0], values[1], values[2], Quantity_TOC_RGB)
+
+
+def make_compound(shapes):
+    builder = BRep_Builder()
+    compound = TopoDS_Compound()
+    builder.MakeCompound(compound)
+    for shape in shapes:
+        builder.Add(compound, shape)
+    return compound
+
+
+def mesh_shapes(shapes, level):
+    """按细节层次重新剖分，三角网格保存在面上，写入BRep时一并保存"""
+    if level not in MESH_LEVELS:
+        raise ValueError(f"不支持的细节层次: {level}")
+    linear, angular = MESH_LEVELS[level]
+    compound = make_compound(shapes)
+    # 已有更精细的网格时不会重新剖分，需要先清除
+    breptools.Clean(compound)
+    BRepMesh_IncrementalMesh(compound, linear, True, angular, True)
+    return shapes
+
+
+def write_shapes(shapes, brep_path, meta_path):
+    """所有形状按顺序放入一个复合体写为二进制BRep，名称和颜色按相同顺序写入json"""
+    compound = make_compound(shapes)
+    meta = [[name, color_to_list(color)] for name, color in shapes.values()]
+
+    tmp_brep_path = brep_path + '.tmp'
+    tmp_meta_path = meta_path + '.tmp'
+    if not bintools.Write(compound, tmp_brep_path):
+        raise OSError(f"无法写入BRep文件: {brep_path}")
+    with open(tmp_meta_path, 'w', encoding='utf-8') as f:
+        json.dump({'version': CACHE_VERSION, 'shapes': meta}, f, ensure_ascii=False)
+    # json最后替换，存在json即表示BRep文件完整
+    os.replace(tmp_brep_path, brep_path)
+    os.replace(tmp_meta_path, meta_path)
+
+
+def read_shapes(brep_path, meta_path):
+    with open(meta_path, 'r', encoding='utf-8') as f:
+        meta = json.load(f)
+    if meta.get('version') != CACHE_VERSION:
+        raise ValueError(f"缓存版本不符: {meta_path}")
+
+    compound = TopoDS_Shape()
+    if not bintools.Read(compound, brep_path):
+        raise OSError(f"无法读取BRep文件: {brep_path}")
+
+    shapes = {}
+    iterator = TopoDS_Iterator(compound)
+    for name, color in meta['shapes']:
+        if not iterator.More():
+            raise ValueError(f"缓存内容不完整: {brep_path}")
+        shapes[iterator.Value()] = [name, list_to_color(color)]
+        iterator.Next()
+    return shapes
+
+
+class BRepCache:
+    """按STEP文件路径/大小/修改时间索引的BRep缓存，总大小超过max_bytes时删除最久未使用的项"""
+
+    def __init__(self, cache_dir=None, max_bytes=2 * 1024 ** 3):
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.max_bytes = max_bytes
+        # 缓存总大小的累计值，写入时增加、淘汰时按扫描结果校正；首次需要时扫描目录得到
+        self.total_bytes = None
+
+    def paths(self, key):
+        return (os.path.join(self.cache_dir, key + BREP_SUFFIX),
+                os.path.join(self.cache_dir, key + META_SUFFIX))
+
+    def read(self, step_path, level=None):
+        """读取已缓存的模型，未缓存或缓存损坏时返回None"""
+        brep_path, meta_path = self.paths(cache_key(step_path, level))
+        if not (os.path.isfile(meta_path) and os.path.isfile(brep_path)):
+            return None
+        try:
+            shapes = read_shapes(brep_path, meta_path)
+            # 用修改时间记录最近一次使用，淘汰时参考
+            os.utime(brep_path)
+        except (OSError, ValueError, KeyError, RuntimeError):
+            return None
+        return shapes
+
+    def write(self, step_path, shapes, level=None):
+        brep_path, meta_path = self.paths(cache_key(step_path, level))
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            write_shapes(shapes, brep_path, meta_path)
+            if self.total_bytes is not None:
+                self.total_bytes += os.path.getsize(brep_path) + os.path.getsize(meta_path)
+        except (OSError, RuntimeError):
+            # 缓存写入失败不影响模型显示
+            return False
+        return True
+
+    def load(self, step_path, level=None, evict=True):
+        """返回与read_step_file_with_names_colors相同的{shape: [name, color]}
+
+        指定level时返回已按该细节层次剖分好的模型。
+        """
+        shapes = self.read(step_path, level)
+        if shapes is not None:
+            return shapes
+        if level:
+            # 已缓存其他层次时从二进制文件重新剖分，不必再解析STEP
+            for other in (None,) + tuple(MESH_LEVELS):
+                if other != level and self.contains(step_path, other):
+                    shapes = self.read(step_path, other)
+                    if shapes is not None:
+                        break
+        if shapes is None:
+            # STEP读取模块较大，缓存全部命中时不必加载
+            from OCC.Extend.DataExchange import read_step_file_with_names_colors
+
+            shapes = read_step_file_with_names_colors(step_path)
+        if level:
+            mesh_shapes(shapes, level)
+        if self.write(step_path, shapes, level) and evict:
+            self.evict_if_needed()
+        return shapes
+
+    def contains(self, step_path, level=None):
+        brep_path, meta_path = self.paths(cache_key(step_path, level))
+        return os.path.isfile(meta_path) and os.path.isfile(brep_path)
+
+    def entries(self):
+        """返回[(最近使用时间, 大小, 缓存键)]"""
+        if not os.path.isdir(self.cache_dir):
+            return []
+        entries = []
+        for item in os.listdir(self.cache_dir):
+            if not item.endswith(BREP_SUFFIX):
+                continue
+            key = item[:-len(BREP_SUFFIX)]
+            brep_path, meta_path = self.paths(key)
+            try:
+                stat = os.stat(brep_path)
+                size = stat.st_size + (os.path.getsize(meta_path) if os.path.isfile(meta_path) else 0)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, size, key))
+        return entries
+
+    @property
+    def nbytes(self):
+        return sum(entry[1] for entry in self.entries())
+
+    def remove(self, key):
+        for path in self.paths(key):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def evict_if_needed(self):
+        """累计大小超过max_bytes时才扫描缓存目录淘汰，避免每次写入都列出全部缓存项"""
+        if self.max_bytes is None:
+            return 0
+        if self.total_bytes is not None and self.total_bytes <= self.max_bytes:
+            return 0
+        return self.evict()
+
+    def evict(self):
+        """删除最久未使用的缓存项直到总大小不超过max_bytes，返回删除的项数"""
+        if self.max_bytes is None:
+            return 0
+        entries = sorted(self.entries())
+        total = sum(entry[1] for entry in entries)
+        removed = 0
+        for _, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            self.remove(key)
+            total -= size
+            removed += 1
+        # 其他进程(预热、预读)写入的缓存项也在这里计入
+        self.total_bytes = total
+        return removed
+
+    def clear(self):
+        for _, _, key in self.entries():
+            self.remove(key)
+        self.total_bytes = 0
+
+    def warm(self, folder_path, workers=1, levels=('coarse', 'fine'), log=print):
+        """预先转换检索目录下所有STEP文件并按各细节层次剖分，返回(新转换数, 已缓存数, 失败数)"""
+        levels = tuple(levels) or (None,)
+        all_paths = get_file_paths(folder_path)
+        step_paths = [path for path in all_paths if not all(self.contains(path, level) for level in levels)]
+        cached = len(all_paths) - len(step_paths)
+        converted = failed = 0
+
+        if workers <= 1:
+            results = (warm_file(self.cache_dir, path, levels) for path in step_paths)
+            for path, error in results:
+                converted, failed = report_warm(path, error, converted, failed, log)
+        else:
+            with ProcessPoolExecutor(workers) as pool:
+                for path, error in pool.map(warm_file, [self.cache_dir] * len(step_paths), step_paths,
+                                            [levels] * len(step_paths)):
+                    converted, failed = report_warm(path, error, converted, failed, log)
+
+        self.evict()
+        log(f"缓存预热完成: 新转换 {converted} 个, 已缓存 {cached} 个, 失败 {failed} 个")
+        return converted, cached, failed
+
+
+def warm_file(cache_dir, step_path, levels=(None,)):
+    # 在工作进程中执行，淘汰统一在预热结束后进行
+    try:
+        cache = BRepCache(cache_dir, max_bytes=None)
+        for level in levels:
+            cache.load(step_path, level, evict=False)
+    except Exception as e:
+        return step_path, str(e)
+    return step_path, None
+
+
+def report_warm(path, error, converted, failed, log):
+    if error is None:
+        return converted + 1, failed
+    log(f"转换失败 {path}: {error}")
+    return converted, failed + 1
+
+
+brep_cache = BRepCache()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="STEP模型二进制BRep缓存")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    warm = subparsers.add_parser('warm', help="预先转换检索目录下的所有STEP文件")
+    warm.add_argument('folder', help="STEP文件目录")
+    warm.add_argument('--workers', type=int, default=1, help="并行进程数")
+    warm.add_argument('--levels', nargs='*', default=['coarse', 'fine'], choices=list(MESH_LEVELS),
+                      help="预先剖分的细节层次")
+
+    subparsers.add_parser('evict', help="按大小上限清理缓存")
+    subparsers.add_parser('clear', help="删除全部缓存")
+
+    for subparser in subparsers.choices.values():
+        subparser.add_argument('--cache-dir', default=None, help="缓存目录，默认 ~/cad_temp/brep_cache")
+        subparser.add_argument('--max-mb', type=float, default=2048, help="缓存总大小上限(MB)")
+    args = parser.parse_args(argv)
+
+    cache = BRepCache(args.cache_dir, int(args.max_mb * 1024 * 1024))
+    if args.command == 'warm':
+        cache.warm(args.folder, args.workers, args.levels)
+    elif args.command == 'evict':
+        print(f"已删除 {cache.evict()} 个缓存项", file=sys.stderr)
+    elif args.command == 'clear':
+        cache.clear()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
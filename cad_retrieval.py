@@ -0,0 +1,143 @@
+"""无界面批量检索入口，不依赖PyQt5和OCC
+
+用法:
+    python -m cad_retrieval search --queries queries/ --db database.npy --steps steps/ --k 50 --workers 4
+"""
+import os
+import sys
+import csv
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from similarity_calculator import get_database, process_queries
+
+_worker_database = {}
+
+
+def load_queries(query_input):
+    """读取查询特征: 单个.npy文件或包含.npy文件的目录，返回(名称列表, 查询矩阵)"""
+    if os.path.isdir(query_input):
+        files = sorted(item for item in os.listdir(query_input) if item.endswith('.npy'))
+        paths = [os.path.join(query_input, item) for item in files]
+    else:
+        paths = [query_input]
+
+    names = []
+    features = []
+    for path in paths:
+        feature = np.atleast_2d(np.load(path, allow_pickle=True))
+        base = os.path.basename(path)
+        if len(feature) == 1:
+            names.append(base)
+        else:
+            names.extend(f"{base}[{i}]" for i in range(len(feature)))
+        features.append(feature)
+    if not features:
+        return [], np.zeros((0, 0), dtype=np.float32)
+    return names, np.vstack(features).astype(np.float32)
+
+
+def init_worker(database_input, is_single_file, quantization):
+    # 每个工作进程只加载一次数据库，后续任务直接复用
+    _worker_database['args'] = (database_input, is_single_file, quantization)
+    get_database(database_input, is_single_file, quantization)
+
+
+def search_chunk(names, x, step_folder, k, dis, nprobe):
+    database_input, is_single_file, quantization = _worker_database['args']
+    all_paths, all_scores = process_queries(
+        x, database_input, step_folder, is_single_file, k=k, dis=dis, nprobe=nprobe, quantization=quantization)
+    records = []
+    for name, paths, scores in zip(names, all_paths, all_scores):
+        records.append({
+            'query': name,
+            'results': [{'rank': rank + 1, 'path': path, 'similarity': round(100 - score, 4)}
+                        for rank, (path, score) in enumerate(zip(paths, scores))],
+        })
+    return records
+
+
+def iter_chunks(names, x, chunk_size):
+    for start in range(0, len(x), chunk_size):
+        yield names[start:start + chunk_size], x[start:start + chunk_size]
+
+
+def run_search(args):
+    names, x = load_queries(args.queries)
+    if not names:
+        print(f"未找到查询特征: {args.queries}", file=sys.stderr)
+        return 1
+
+    is_single_file = not os.path.isdir(args.db)
+    init_args = (args.db, is_single_file, args.quantization)
+    search_args = (args.steps, args.k, args.dis, args.nprobe)
+
+    if args.workers <= 1:
+        init_worker(*init_args)
+        results = (search_chunk(chunk_names, chunk, *search_args)
+                   for chunk_names, chunk in iter_chunks(names, x, args.chunk_size))
+        write_results(results, args)
+        return 0
+
+    if args.dis == 'ivf':
+        # IVF索引在父进程中训练(或加载)并保存一次，工作进程直接读取，不会各自训练后同时写入
+        get_database(*init_args).get_ivf_index()
+
+    with ProcessPoolExecutor(args.workers, initializer=init_worker, initargs=init_args) as pool:
+        futures = [pool.submit(search_chunk, chunk_names, chunk, *search_args)
+                   for chunk_names, chunk in iter_chunks(names, x, args.chunk_size)]
+        # 按提交顺序输出，保证结果顺序与查询顺序一致
+        write_results((future.result() for future in futures), args)
+    return 0
+
+
+def write_results(chunks, args):
+    out = open(args.output, 'w', encoding='utf-8', newline='') if args.output else sys.stdout
+    try:
+        if args.format == 'csv':
+            writer = csv.writer(out)
+            writer.writerow(['query', 'rank', 'path', 'similarity'])
+            for records in chunks:
+                for record in records:
+                    for result in record['results']:
+                        writer.writerow([record['query'], result['rank'], result['path'], result['similarity']])
+        else:
+            for records in chunks:
+                for record in records:
+                    out.write(json.dumps(record, ensure_ascii=False) + '\n')
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='cad_retrieval', description="CAD模型批量检索(无界面)")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    search = subparsers.add_parser('search', help="批量检索")
+    search.add_argument('--queries', required=True, help="查询特征文件(.npy)或目录")
+    search.add_argument('--db', required=True, help="数据库特征文件(.npy)或特征目录")
+    search.add_argument('--steps', required=True, help="数据库对应的STEP文件目录")
+    search.add_argument('--k', type=int, default=50, help="每个查询返回的结果数")
+    search.add_argument('--dis', default='euclidean', choices=['euclidean', 'cos', 'ivf'])
+    search.add_argument('--nprobe', type=int, default=8,
+                        help="IVF检索时探测的桶数；IVF得分的归一化范围由探测的桶估计，与精确检索的得分近似一致")
+    search.add_argument('--quantization', default=None, choices=['float16', 'int8'])
+    search.add_argument('--workers', type=int, default=1, help="并行进程数")
+    search.add_argument('--chunk-size', type=int, default=256, help="每个任务包含的查询数")
+    search.add_argument('--format', default='jsonl', choices=['jsonl', 'csv'])
+    search.add_argument('--output', default=None, help="输出文件，默认输出到stdout")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.command == 'search':
+        return run_search(args)
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
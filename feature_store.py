@@ -0,0 +1,253 @@
+import os
+import json
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+STORE_DIR = '.feature_store'
+# 旧版清单没有记录矩阵文件名时使用
+MATRIX_FILE = 'features.npy'
+MATRIX_PREFIX = 'features'
+MANIFEST_FILE = 'manifest.json'
+STORE_VERSION = 2
+
+
+def list_feature_files(folder_path):
+    return sorted(item for item in os.listdir(folder_path) if item.endswith('.npy'))
+
+
+def feature_file_stats(folder_path):
+    """[[文件名, 大小, 修改时间]]，按文件名排序；原地覆盖文件时目录修改时间不变，需要逐个比较"""
+    stats = []
+    with os.scandir(folder_path) as it:
+        for entry in it:
+            if entry.name.endswith('.npy') and entry.is_file():
+                st = entry.stat()
+                stats.append([entry.name, st.st_size, st.st_mtime_ns])
+    stats.sort()
+    return stats
+
+
+def read_npy_shape(file_path):
+    # 只读取.npy文件头获得形状，不加载数据
+    with open(file_path, 'rb') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, _, _ = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, _, _ = np.lib.format.read_array_header_2_0(f)
+    if len(shape) == 1:
+        return (1, shape[0])
+    return shape
+
+
+def default_io_workers():
+    # 读取以磁盘/网络I/O为主，线程数可以多于CPU核数
+    return min(32, (os.cpu_count() or 1) * 4)
+
+
+def read_feature_shapes(folder_path, feature_files, max_workers=None):
+    paths = [os.path.join(folder_path, item) for item in feature_files]
+    with ThreadPoolExecutor(max_workers or default_io_workers()) as pool:
+        shapes = list(pool.map(read_npy_shape, paths))
+    dims = {shape[1] for shape in shapes}
+    if len(dims) > 1:
+        raise ValueError(f"特征维度不一致: {sorted(dims)}")
+    return shapes
+
+
+def load_feature_files(folder_path, feature_files, out=None, dtype=np.float32, max_workers=None, progress=None,
+                       batch_size=256):
+    """并行读取特征文件，按feature_files的顺序写入预先分配的矩阵
+
+    每读完batch_size个文件回调一次progress('loading', fraction)，回调中可抛出异常中止读取。
+    """
+    shapes = read_feature_shapes(folder_path, feature_files, max_workers)
+    rows = sum(shape[0] for shape in shapes)
+    dim = shapes[0][1] if shapes else 0
+    if out is None:
+        out = np.empty((rows, dim), dtype=dtype)
+    offsets = np.zeros(len(shapes) + 1, dtype=np.int64)
+    np.cumsum([shape[0] for shape in shapes], out=offsets[1:])
+
+    def load_into(i):
+        feature = np.atleast_2d(np.load(os.path.join(folder_path, feature_files[i]), allow_pickle=True))
+        out[offsets[i]:offsets[i + 1]] = feature
+
+    with ThreadPoolExecutor(max_workers or default_io_workers()) as pool:
+        # 分批提交，中止时只需等待当前一批完成；list()使线程中的异常在这里抛出
+        for start in range(0, len(feature_files), batch_size):
+            stop = min(start + batch_size, len(feature_files))
+            list(pool.map(load_into, range(start, stop)))
+            if progress:
+                progress('loading', stop / len(feature_files))
+    return out, shapes
+
+
+class FeatureFileRows:
+    """未打包的特征目录按行读取: 每个文件以内存映射方式打开，只读取用到的行
+
+    支持切片和行号数组索引，返回float32矩阵；量化模式下代替完整的全精度矩阵。
+    """
+
+    def __init__(self, folder_path, feature_files=None):
+        self.folder_path = folder_path
+        self.feature_files = feature_files if feature_files is not None else list_feature_files(folder_path)
+        shapes = read_feature_shapes(folder_path, self.feature_files)
+        self.offsets = np.zeros(len(shapes) + 1, dtype=np.int64)
+        np.cumsum([shape[0] for shape in shapes], out=self.offsets[1:])
+        self.shape = (int(self.offsets[-1]), shapes[0][1] if shapes else 0)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def file_rows(self, i):
+        path = os.path.join(self.folder_path, self.feature_files[i])
+        try:
+            return np.atleast_2d(np.load(path, mmap_mode='r'))
+        except ValueError:
+            # 含Python对象的文件无法内存映射
+            return np.atleast_2d(np.load(path, allow_pickle=True))
+
+    def __getitem__(self, rows):
+        if isinstance(rows, slice):
+            rows = np.arange(*rows.indices(len(self)))
+        rows = np.asarray(rows, dtype=np.int64)
+        out = np.empty((len(rows), self.shape[1]), dtype=np.float32)
+        files = np.searchsorted(self.offsets, rows, side='right') - 1
+        for i in np.unique(files):
+            mask = files == i
+            out[mask] = self.file_rows(i)[rows[mask] - self.offsets[i]]
+        return out
+
+
+def find_step_file(step_folder, feature_file):
+    # 特征文件与STEP文件通过文件名(不含扩展名)对应
+    if not step_folder:
+        return None
+    stem = os.path.splitext(feature_file)[0]
+    for ext in ('.step', '.stp', '.STEP', '.STP'):
+        if os.path.isfile(os.path.join(step_folder, stem + ext)):
+            return stem + ext
+    return None
+
+
+def build_feature_store(folder_path, step_folder=None, log=print):
+    """将特征目录打包为一个连续的float32矩阵和清单文件"""
+    feature_files = list_feature_files(folder_path)
+    if not feature_files:
+        raise ValueError(f"目录中没有特征文件: {folder_path}")
+
+    # 读取前记录各文件状态，打包过程中被修改的文件下次打开时即视为过期
+    file_stats = feature_file_stats(folder_path)
+    # 先读取文件头确定总行数和维度
+    shapes = read_feature_shapes(folder_path, feature_files)
+    dim = shapes[0][1]
+    rows = sum(shape[0] for shape in shapes)
+
+    store_dir = os.path.join(folder_path, STORE_DIR)
+    os.makedirs(store_dir, exist_ok=True)
+    manifest_path = os.path.join(store_dir, MANIFEST_FILE)
+
+    # 每次打包写入新的矩阵文件，不覆盖界面或服务可能正以内存映射打开的旧文件(Windows下无法替换)；
+    # 清单替换后才生效
+    fd, matrix_path = tempfile.mkstemp(prefix=MATRIX_PREFIX + '-', suffix='.npy', dir=store_dir)
+    os.close(fd)
+    matrix = np.lib.format.open_memmap(matrix_path, mode='w+', dtype=np.float32, shape=(rows, dim))
+    load_feature_files(folder_path, feature_files, out=matrix)
+    entries = []
+    for item, shape in zip(feature_files, shapes):
+        step_name = find_step_file(step_folder, item)
+        entries.extend([[item, step_name]] * shape[0])
+    matrix.flush()
+    del matrix
+
+    manifest = {
+        'version': STORE_VERSION,
+        'rows': rows,
+        'dim': dim,
+        'source_mtime_ns': os.stat(folder_path).st_mtime_ns,
+        'file_count': len(feature_files),
+        'files': file_stats,
+        'matrix': os.path.basename(matrix_path),
+        'entries': entries,
+    }
+    tmp_manifest_path = manifest_path + '.tmp'
+    with open(tmp_manifest_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(tmp_manifest_path, manifest_path)
+    remove_old_matrices(store_dir, os.path.basename(matrix_path))
+    log(f"已打包 {len(feature_files)} 个特征文件, 共 {rows} 行, 维度 {dim}: {store_dir}")
+    return store_dir
+
+
+def remove_old_matrices(store_dir, current):
+    # 仍被其他进程映射的旧文件删除失败时保留，下次打包再删除
+    for item in os.listdir(store_dir):
+        if item != current and item.startswith(MATRIX_PREFIX) and item.endswith('.npy'):
+            try:
+                os.remove(os.path.join(store_dir, item))
+            except OSError:
+                pass
+
+
+class FeatureStore:
+    def __init__(self, folder_path, features, manifest):
+        self.folder_path = folder_path
+        self.features = features
+        self.manifest = manifest
+
+    @property
+    def feature_files(self):
+        return [entry[0] for entry in self.manifest['entries']]
+
+    def step_paths(self, step_folder):
+        # 清单中记录了每一行对应的STEP文件时直接使用，否则返回None
+        entries = self.manifest['entries']
+        if not entries or any(entry[1] is None for entry in entries):
+            return None
+        return [os.path.join(step_folder, entry[1]) for entry in entries]
+
+
+def open_feature_store(folder_path):
+    """打开目录中已打包的特征库(内存映射)，不存在或已过期时返回None"""
+    store_dir = os.path.join(folder_path, STORE_DIR)
+    manifest_path = os.path.join(store_dir, MANIFEST_FILE)
+    if not os.path.isfile(manifest_path):
+        return None
+
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if manifest.get('version') != STORE_VERSION:
+        return None
+    # 目录修改时间变化(增删文件)说明特征库已过期
+    if manifest.get('source_mtime_ns') != os.stat(folder_path).st_mtime_ns:
+        return None
+    # 原地覆盖的特征文件不改变目录修改时间，逐个比较大小和修改时间
+    if manifest.get('files') != feature_file_stats(folder_path):
+        return None
+
+    matrix_path = os.path.join(store_dir, manifest.get('matrix', MATRIX_FILE))
+    if not os.path.isfile(matrix_path):
+        return None
+    features = np.load(matrix_path, mmap_mode='r')
+    if features.shape != (manifest['rows'], manifest['dim']):
+        return None
+    return FeatureStore(folder_path, features, manifest)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="特征库打包工具")
+    parser.add_argument('folder', help="特征文件(.npy)目录")
+    parser.add_argument('--steps', default=None, help="对应的STEP文件目录，用于生成行到模型的清单")
+    args = parser.parse_args()
+    build_feature_store(args.folder, args.steps)
+
+
+if __name__ == "__main__":
+    main()
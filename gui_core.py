@@ -1,17 +1,15 @@
 import os
-import numpy as np
 import tempfile
 from datetime import datetime
 from PyQt5.QtWidgets import (
     QDialog, QPushButton, QHBoxLayout, QVBoxLayout, QFileDialog, QLabel,
     QWidget, QGridLayout, QSizePolicy, QMessageBox, QProgressBar,
     QTextEdit, QFrame, QScrollArea, QStackedWidget, QListWidget,
-    QRadioButton, QSpinBox, QColorDialog, QApplication
+    QRadioButton, QSpinBox, QColorDialog, QApplication, QComboBox
 )
 from PyQt5.QtCore import Qt, QSize, QEvent, QTranslator
 from PyQt5.QtGui import QFontMetrics, QIcon, QColor, QFont
 
-from OCC.Extend.DataExchange import read_step_file_with_names_colors
 from OCC.Display.backend import load_backend
 
 load_backend("pyqt5")
@@ -19,7 +17,9 @@ from OCC.Core.Quantity import Quantity_Color, Quantity_TOC_RGB
 from OCC.Display import qtDisplay
 from OCC.Core.Graphic3d import Graphic3d_BufferType
 
-from similarity_calculator import process_query
+from shape_cache import load_step_shapes
+from page_prefetcher import PagePrefetcher
+from gui_worker import SearchWorker, MainThreadDispatcher
 from gui_widgets import CustomLabel, ClassLabel
 from gui_report import ReportGenerator
 from gui_utils import ButtonStyles, MessageUtils
@@ -71,7 +71,8 @@ class CADRetrievalApp(QDialog):
                 "保存结果": "保存结果",
                 "生成报告": "生成报告",
                 "清除显示": "清除显示",
-                "帮助": "帮助"
+                "帮助": "帮助",
+                "取消检索": "取消检索"
             },
             'en': {
                 "上传模型": "Upload Model",
@@ -84,13 +85,17 @@ class CADRetrievalApp(QDialog):
                 "保存结果": "Save Results",
                 "生成报告": "Generate Report",
                 "清除显示": "Clear Display",
-                "帮助": "Help"
+                "帮助": "Help",
+                "取消检索": "Cancel Search"
             }
         }
 
         for text, btn in self.button_refs.items():
             btn.setText(button_texts[self.current_language].get(text, text))
 
+        for i, (text, dis) in enumerate(self.metricItems()):
+            self.metricCombo.setItemText(i, text)
+
         # 更新其他UI元素
         if self.current_language == 'en':
             self.uploaded_class_label.setText("Uploaded Class: None")
@@ -100,6 +105,8 @@ class CADRetrievalApp(QDialog):
             self.prevButton.setText("◀ Previous")
             self.nextButton.setText("Next ▶")
             self.resultNumSpin.setSuffix(" results")
+            self.metricLabel.setText("Search method:")
+            self.nprobeLabel.setText("Probed lists (nprobe):")
             self.pageLabel.setText(f"Page {self.current_page + 1} / {self.total_pages}")
             for label in self.labels:
                 label.setText("Similarity: 0.0")
@@ -113,6 +120,8 @@ class CADRetrievalApp(QDialog):
             self.prevButton.setText("◀ 上一页")
             self.nextButton.setText("下一页 ▶")
             self.resultNumSpin.setSuffix(" 个结果")
+            self.metricLabel.setText("检索方式:")
+            self.nprobeLabel.setText("探测桶数(nprobe):")
             self.pageLabel.setText(f"第 {self.current_page + 1} 页 / 共 {self.total_pages} 页")
             for label in self.labels:
                 label.setText("相似度: 0.0")
@@ -123,7 +132,9 @@ class CADRetrievalApp(QDialog):
         self.ais_list = []
         self.labels = []
         self.class_labels = []
-        self.canvases = []
+        # 结果视图在第一次显示3D结果时才创建，未创建的位置为None
+        self.canvases = [None] * 8
+        self.canvas_layouts = []
         self.current_class = None
         self.feature_file = None
         self.database_file = None
@@ -144,6 +155,13 @@ class CADRetrievalApp(QDialog):
         self.correct_color = Quantity_Color(0.0, 1.0, 0.0, Quantity_TOC_RGB)
         self.incorrect_color = Quantity_Color(1.0, 0.0, 0.0, Quantity_TOC_RGB)
         self.button_refs = {}
+        # 每次检索递增，后台线程返回的旧结果不会覆盖新的检索
+        self.search_id = 0
+        self.search_worker = None
+        # 所有仍在运行的检索线程(包括被新检索或清除操作取代的)，关闭窗口时逐个等待退出
+        self.search_workers = set()
+        # 预读完成后在界面线程中把模型读入内存缓存
+        self.prefetcher = PagePrefetcher(dispatch=MainThreadDispatcher(self))
         self.setupTempDir()
         self.report_generator = ReportGenerator(self)
 
@@ -298,7 +316,17 @@ class CADRetrievalApp(QDialog):
                 background-color: #4CAF50;
             }
         """)
-        leftLayout.addWidget(self.progressBar)
+        self.cancelButton = QPushButton("取消检索" if self.current_language == 'zh' else "Cancel Search")
+        self.cancelButton.setMinimumHeight(24)
+        ButtonStyles.setHelpStyle(self.cancelButton)
+        self.cancelButton.setEnabled(False)
+        self.cancelButton.clicked.connect(self.cancelSearch)
+        self.button_refs["取消检索"] = self.cancelButton
+
+        progressLayout = QHBoxLayout()
+        progressLayout.addWidget(self.progressBar, 1)
+        progressLayout.addWidget(self.cancelButton)
+        leftLayout.addLayout(progressLayout)
 
         self.logArea = QTextEdit()
         self.logArea.setReadOnly(True)
@@ -403,8 +431,45 @@ class CADRetrievalApp(QDialog):
         controlGrid.addWidget(QLabel("返回结果数:" if self.current_language == 'zh' else "Results count:"), 9, 0)
         controlGrid.addWidget(self.resultNumSpin, 9, 1)
 
+        # 检索方式: 精确欧氏距离/余弦距离，或IVF近似检索
+        self.metricLabel = QLabel("检索方式:" if self.current_language == 'zh' else "Search method:")
+        self.metricCombo = QComboBox()
+        for text, dis in self.metricItems():
+            self.metricCombo.addItem(text, dis)
+        self.metricCombo.setStyleSheet("""
+            QComboBox {
+                font-size: 11pt;
+                padding: 3px;
+            }
+        """)
+        self.metricCombo.currentIndexChanged.connect(self.updateNprobeState)
+        controlGrid.addWidget(self.metricLabel, 10, 0)
+        controlGrid.addWidget(self.metricCombo, 10, 1)
+
+        self.nprobeLabel = QLabel("探测桶数(nprobe):" if self.current_language == 'zh' else "Probed lists (nprobe):")
+        self.nprobeSpin = QSpinBox()
+        self.nprobeSpin.setRange(1, 1024)
+        self.nprobeSpin.setValue(8)
+        self.nprobeSpin.setStyleSheet("""
+            QSpinBox {
+                font-size: 11pt;
+                padding: 3px;
+            }
+        """)
+        controlGrid.addWidget(self.nprobeLabel, 11, 0)
+        controlGrid.addWidget(self.nprobeSpin, 11, 1)
+        self.updateNprobeState()
+
         return controlGrid
 
+    def metricItems(self):
+        if self.current_language == 'zh':
+            return [("欧氏距离", 'euclidean'), ("余弦距离", 'cos'), ("IVF近似检索", 'ivf')]
+        return [("Euclidean", 'euclidean'), ("Cosine", 'cos'), ("IVF approximate", 'ivf')]
+
+    def updateNprobeState(self):
+        self.nprobeSpin.setEnabled(self.metricCombo.currentData() == 'ivf')
+
     def createRightPanel(self):
         rightPanel = QWidget()
         rightLayout = QVBoxLayout(rightPanel)
@@ -423,8 +488,9 @@ class CADRetrievalApp(QDialog):
 
         for i in range(8):
             row, col = divmod(i, 4)
-            canvas = qtDisplay.qtViewer3d(self)
-            canvas.setMinimumHeight(140)
+            # 先用空白控件占位，需要时由ensureCanvas替换为3D视图
+            placeholder = QWidget()
+            placeholder.setMinimumHeight(140)
 
             label_layout = QVBoxLayout()
             label_layout.setSpacing(2)
@@ -447,10 +513,10 @@ class CADRetrievalApp(QDialog):
             frameLayout = QVBoxLayout(frame)
             frameLayout.setContentsMargins(2, 2, 2, 2)
             frameLayout.setSpacing(3)
-            frameLayout.addWidget(canvas, 1)
+            frameLayout.addWidget(placeholder, 1)
             frameLayout.addLayout(label_layout)
 
-            self.canvases.append(canvas)
+            self.canvas_layouts.append(frameLayout)
             self.labels.append(similarity_label)
             self.class_labels.append(class_label)
             resultsGrid.addWidget(frame, row, col)
@@ -515,7 +581,8 @@ class CADRetrievalApp(QDialog):
                 "保存结果": "将检索结果导出为文本文件",
                 "生成报告": "生成PDF或HTML格式的检索报告",
                 "清除显示": "重置所有显示内容",
-                "帮助": "显示使用说明文档"
+                "帮助": "显示使用说明文档",
+                "取消检索": "中止正在进行的检索"
             },
             'en': {
                 "上传模型": "Load STEP model file for retrieval",
@@ -528,7 +595,8 @@ class CADRetrievalApp(QDialog):
                 "保存结果": "Export search results as text file",
                 "生成报告": "Generate PDF or HTML report",
                 "清除显示": "Reset all displays",
-                "帮助": "Show user manual"
+                "帮助": "Show user manual",
+                "取消检索": "Stop the running search"
             }
         }
 
@@ -544,6 +612,11 @@ class CADRetrievalApp(QDialog):
         self.current_class = history_item["class"]
         self.step_file_path = history_item.get("step_file")
 
+        metric_index = self.metricCombo.findData(history_item.get("dis", 'euclidean'))
+        if metric_index >= 0:
+            self.metricCombo.setCurrentIndex(metric_index)
+        self.nprobeSpin.setValue(history_item.get("nprobe", self.nprobeSpin.value()))
+
         if history_item["is_single_file"]:
             self.single_file_rb.setChecked(True)
             self.database_file = history_item["database_input"]
@@ -565,7 +638,8 @@ class CADRetrievalApp(QDialog):
         if self.step_file_path and os.path.exists(self.step_file_path):
             try:
                 self.mainCanvas._display.EraseAll()
-                shapes = read_step_file_with_names_colors(self.step_file_path)
+                self.useCachedMesh(self.mainCanvas._display)
+                shapes = load_step_shapes(self.step_file_path, 'fine')
                 for shape, (label, color) in shapes.items():
                     ais = self.mainCanvas._display.DisplayShape(shape, update=True)
                     self.ais_list.append(ais)
@@ -596,7 +670,9 @@ class CADRetrievalApp(QDialog):
             "result_count": result_count,
             "is_single_file": self.single_file_rb.isChecked(),
             "database_input": self.database_file if self.single_file_rb.isChecked() else self.database_folder,
-            "step_file": self.step_file_path
+            "step_file": self.step_file_path,
+            "dis": self.metricCombo.currentData(),
+            "nprobe": self.nprobeSpin.value()
         })
 
         self.updateHistoryList()
@@ -634,7 +710,8 @@ class CADRetrievalApp(QDialog):
                 )
 
                 self.mainCanvas._display.EraseAll()
-                shapes = read_step_file_with_names_colors(fileName)
+                self.useCachedMesh(self.mainCanvas._display)
+                shapes = load_step_shapes(fileName, 'fine')
                 for shape, (label, color) in shapes.items():
                     ais = self.mainCanvas._display.DisplayShape(shape, update=True)
                     self.ais_list.append(ais)
@@ -792,19 +869,59 @@ class CADRetrievalApp(QDialog):
             )
             return
 
-        try:
-            self.progressBar.setValue(0)
-            input_features = np.load(self.feature_file, allow_pickle=True)
+        max_results = self.resultNumSpin.value()
+        dis = self.metricCombo.currentData()
+        nprobe = self.nprobeSpin.value()
 
-            if self.single_file_rb.isChecked():
-                database_features = np.load(self.database_file, allow_pickle=True)
-                self.result_paths, self.result_scores = process_query(
-                    input_features, database_features, self.search_path, True)
-            else:
-                self.result_paths, self.result_scores = process_query(
-                    input_features, self.database_folder, self.search_path, False)
+        # 数据库特征常驻内存，文件未变化时不会重复加载和归一化
+        if self.single_file_rb.isChecked():
+            database_input, is_single_file = self.database_file, True
+        else:
+            database_input, is_single_file = self.database_folder, False
+
+        # 新的检索开始时中止上一次仍在进行的检索和预读
+        if self.search_worker is not None:
+            self.search_worker.cancel()
+        self.prefetcher.cancel()
+        self.search_id += 1
+        self.search_params = {"max_results": max_results, "dis": dis, "nprobe": nprobe}
+
+        worker = SearchWorker(self.search_id, self.feature_file, database_input, is_single_file,
+                              self.search_path, max_results, dis, nprobe, self.current_language, self)
+        worker.progress.connect(self.onSearchProgress)
+        worker.succeeded.connect(self.onSearchFinished)
+        worker.failed.connect(self.onSearchFailed)
+        worker.cancelled.connect(self.onSearchCancelled)
+        worker.log.connect(self.logMessage)
+        worker.finished.connect(lambda: self.search_workers.discard(worker))
+        worker.finished.connect(worker.deleteLater)
+        self.search_worker = worker
+        self.search_workers.add(worker)
+
+        self.progressBar.setValue(0)
+        self.cancelButton.setEnabled(True)
+        worker.start()
 
-            max_results = self.resultNumSpin.value()
+    def isCurrentSearch(self, search_id):
+        return search_id == self.search_id
+
+    def onSearchProgress(self, search_id, stage, fraction):
+        if not self.isCurrentSearch(search_id):
+            return
+        # 各阶段在进度条上所占的区间
+        stage_ranges = {'loading': (0, 30), 'scoring': (30, 80), 'ranking': (80, 90), 'rendering': (90, 100)}
+        low, high = stage_ranges.get(stage, (0, 100))
+        value = int(low + (high - low) * min(max(fraction, 0.0), 1.0))
+        self.progressBar.setValue(max(value, self.progressBar.value()))
+
+    def onSearchFinished(self, search_id, result_paths, result_scores):
+        if not self.isCurrentSearch(search_id):
+            return
+        self.search_worker = None
+        self.cancelButton.setEnabled(False)
+        max_results = self.search_params["max_results"]
+        try:
+            self.result_paths, self.result_scores = result_paths, result_scores
 
             if len(self.result_paths) > max_results:
                 self.result_paths = self.result_paths[:max_results]
@@ -822,6 +939,7 @@ class CADRetrievalApp(QDialog):
             self.current_page = 0
             self.total_pages = (len(self.result_paths) + 7) // 8
 
+            self.onSearchProgress(search_id, 'rendering', 0)
             self.updatePageControls()
             self.showCurrentPage()
 
@@ -839,10 +957,57 @@ class CADRetrievalApp(QDialog):
                 else f"Error during search: {str(e)}"
             )
 
+    def onSearchFailed(self, search_id, message):
+        if not self.isCurrentSearch(search_id):
+            return
+        self.search_worker = None
+        self.cancelButton.setEnabled(False)
+        self.progressBar.setValue(0)
+        MessageUtils.showErrorMessage(
+            self,
+            f"检索过程中出错: {message}" if self.current_language == 'zh'
+            else f"Error during search: {message}"
+        )
+
+    def onSearchCancelled(self, search_id):
+        if not self.isCurrentSearch(search_id):
+            return
+        self.search_worker = None
+        self.cancelButton.setEnabled(False)
+        self.progressBar.setValue(0)
+        self.logMessage("检索已取消" if self.current_language == 'zh' else "Search cancelled")
+
+    def cancelSearch(self):
+        if self.search_worker is None:
+            return
+        self.search_worker.cancel()
+        self.cancelButton.setEnabled(False)
+        self.logMessage("正在取消检索..." if self.current_language == 'zh' else "Cancelling search...")
+
+    def ensureCanvas(self, index):
+        """返回第index个结果视图，不存在时创建(每个视图都有独立的OpenGL上下文和V3d视图)"""
+        if self.canvases[index] is None:
+            canvas = qtDisplay.qtViewer3d(self)
+            canvas.setMinimumHeight(140)
+            layout = self.canvas_layouts[index]
+            placeholder = layout.itemAt(0).widget()
+            layout.replaceWidget(placeholder, canvas)
+            placeholder.deleteLater()
+            canvas.show()
+            # 视图通常在第一次绘制时初始化，这里马上要显示模型，需要提前初始化
+            if not getattr(canvas, '_inited', False):
+                canvas.InitDriver()
+            self.canvases[index] = canvas
+        return self.canvases[index]
+
+    def createdCanvases(self):
+        return [canvas for canvas in self.canvases if canvas is not None]
+
     def showCurrentPage(self):
+        for canvas in self.createdCanvases():
+            canvas._display.Context.EraseAll(True)
+            canvas._display.FitAll()
         for i in range(8):
-            self.canvases[i]._display.Context.EraseAll(True)
-            self.canvases[i]._display.FitAll()
             self.labels[i].setText("相似度: 0.0" if self.current_language == 'zh' else "Similarity: 0.0")
             self.class_labels[i].setText("类别: 无" if self.current_language == 'zh' else "Class: None")
 
@@ -868,11 +1033,13 @@ class CADRetrievalApp(QDialog):
                 result_class = self.result_classes[i]
 
                 try:
-                    shapes = read_step_file_with_names_colors(path)
+                    # 结果小窗口使用粗糙网格，主视图才使用精细网格
+                    shapes = load_step_shapes(path, 'coarse')
                     if canvas_idx < 8:
-                        canvas = self.canvases[canvas_idx]
+                        canvas = self.ensureCanvas(canvas_idx)
                         display = canvas._display
                         display.EraseAll()
+                        self.useCachedMesh(display)
 
                         for shape, (label, color) in shapes.items():
                             if result_class != self.current_class:
@@ -925,6 +1092,7 @@ class CADRetrievalApp(QDialog):
                 f"第 {self.current_page + 1} 页 / 共 {self.total_pages} 页" if self.current_language == 'zh'
                 else f"Page {self.current_page + 1} / {self.total_pages}"
             )
+            self.prefetchAdjacentPages()
         else:
             if self.current_language == 'zh':
                 self.textResultWidget.append(f"检索结果 (共 {len(self.result_paths)} 个):\n")
@@ -969,6 +1137,18 @@ class CADRetrievalApp(QDialog):
 
         self.updatePageControls()
 
+    def useCachedMesh(self, display):
+        # 模型已带有缓存的三角网格，显示时不再按默认精度重新剖分
+        display.Context.DefaultDrawer().SetAutoTriangulation(False)
+
+    def prefetchAdjacentPages(self):
+        # 用户浏览当前页时在后台预读下一页和上一页的模型
+        paths = []
+        for page in (self.current_page + 1, self.current_page - 1):
+            if 0 <= page < self.total_pages:
+                paths.extend(self.result_paths[page * 8:(page + 1) * 8])
+        self.prefetcher.prefetch(paths)
+
     def updatePageControls(self):
         self.prevButton.setEnabled(self.current_page > 0)
         self.nextButton.setEnabled(self.current_page < self.total_pages - 1 and self.total_pages > 1)
@@ -984,9 +1164,16 @@ class CADRetrievalApp(QDialog):
             self.showCurrentPage()
 
     def clearDisplay(self):
+        # 清除后仍在进行的检索结果不再显示
+        if self.search_worker is not None:
+            self.search_worker.cancel()
+            self.search_worker = None
+        self.search_id += 1
+        self.prefetcher.cancel()
+        self.cancelButton.setEnabled(False)
         self.mainCanvas._display.Context.EraseAll(True)
         self.mainCanvas._display.FitAll()
-        for canvas in self.canvases:
+        for canvas in self.createdCanvases():
             canvas._display.Context.EraseAll(True)
             canvas._display.FitAll()
         self.ais_list = []
@@ -1029,6 +1216,7 @@ class CADRetrievalApp(QDialog):
                 <li><b>Similarity Calculation</b>:
                     <ul>
                         <li>Supports Euclidean distance and cosine similarity</li>
+                        <li>IVF approximate search scans only the nprobe closest clusters; larger nprobe gives higher recall but slower search</li>
                         <li>Feature vectors are L2 normalized</li>
                         <li>Calculate similarity scores between query and database features</li>
                         <li>Score range: 0-100 (100 means most similar)</li>
@@ -1102,6 +1290,7 @@ class CADRetrievalApp(QDialog):
                 <li><b>相似度计算</b>：
                     <ul>
                         <li>支持两种相似度度量方式：欧氏距离和余弦距离</li>
+                        <li>IVF近似检索只扫描最近的nprobe个聚类桶，nprobe越大召回率越高、速度越慢</li>
                         <li>特征向量会先进行L2归一化处理</li>
                         <li>计算查询特征与数据库中所有特征的相似度得分</li>
                         <li>得分范围在0-100之间(100表示最相似)</li>
@@ -1258,5 +1447,17 @@ class CADRetrievalApp(QDialog):
         layout.setContentsMargins(0, 0, 0, 10)
 
         help_dialog.exec_()
+    def closeEvent(self, event):
+        # 窗口关闭前等待所有后台检索线程退出
+        workers = list(self.search_workers)
+        for worker in workers:
+            worker.cancel()
+        for worker in workers:
+            worker.wait()
+        self.search_workers.clear()
+        self.search_worker = None
+        self.prefetcher.shutdown()
+        super().closeEvent(event)
+
     def logMessage(self, message):
         self.logArea.append(message)
\ No newline at end of file
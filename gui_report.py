@@ -1,25 +1,82 @@
 import os
+import io
+import html
 import base64
-import shutil
+import hashlib
 import time
 from datetime import datetime
-from reportlab.lib.pagesizes import letter
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image, PageBreak
-from reportlab.lib.styles import getSampleStyleSheet
-from reportlab.lib import colors
-from reportlab.lib.units import inch
-from PyQt5.QtWidgets import QMessageBox, QFileDialog, QInputDialog, QColorDialog
+from PyQt5.QtWidgets import QApplication, QMessageBox, QFileDialog, QInputDialog, QColorDialog
 from PyQt5.QtGui import QColor
 from OCC.Core.Graphic3d import Graphic3d_BufferType
 from gui_utils import MessageUtils
+from thumbnail_store import ThumbnailStore
+from report_renderer import ReportRenderer
+from image_sheets import SheetWriter
 import sys
 import subprocess
-import tempfile
+
+
+# 图片外置的HTML报告把图片写入报告所在目录下的这个文件夹
+HTML_ASSETS_DIR = 'report_assets'
+
+
+class LazyStory(list):
+    """按需从生成器取出flowable的story
+
+    reportlab排版时只从列表头部取出和插入flowable，这里只在需要时才向后多取几个，
+    已排版的flowable随即释放，内存中只保留当前几页的内容。
+    """
+
+    def __init__(self, flowables, lookahead=4):
+        super().__init__()
+        self.source = iter(flowables)
+        self.lookahead = lookahead
+
+    def fill(self, count):
+        while self.source is not None and list.__len__(self) < count:
+            try:
+                self.append(next(self.source))
+            except StopIteration:
+                self.source = None
+
+    def __len__(self):
+        self.fill(self.lookahead)
+        return list.__len__(self)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            if index.stop is not None and index.stop >= 0:
+                self.fill(index.stop)
+        elif index >= 0:
+            self.fill(index + 1)
+        return list.__getitem__(self, index)
+
+
+class ResultSnapshot:
+    """导出开始时的检索结果副本
+
+    导出过程中会处理界面事件，期间完成的新检索会替换界面上的结果列表，导出只使用这份副本。
+    """
+
+    def __init__(self, parent):
+        self.source = parent.result_paths
+        self.paths = list(parent.result_paths)
+        self.scores = list(parent.result_scores)
+        self.classes = list(parent.result_classes)
+        self.current_class = parent.current_class
+        self.correct_color = parent.correct_color
+        self.incorrect_color = parent.incorrect_color
+
+    def isCurrent(self, parent):
+        # 界面上的结果列表仍是导出开始时的那一份
+        return parent.result_paths is self.source
 
 
 class ReportGenerator:
     def __init__(self, parent):
         self.parent = parent
+        # 正在导出的结果副本，不在导出时为None
+        self.results = None
         self.HAS_PILLOW = self.check_pillow()
         self.image_settings = {
             'width': 800,
@@ -29,6 +86,15 @@ class ReportGenerator:
             'text_color': (0, 0, 0),
             'font_size': 20
         }
+        # 与报告图片同尺寸的离线缩略图可直接使用，不必重新渲染
+        self.thumbnail_store = ThumbnailStore(size=self.reportSize())
+        # 大结果集PDF: 每页columns×rows个结果，图片按dpi缩小后压缩为JPEG
+        self.large_pdf_settings = {
+            'columns': 3,
+            'rows': 4,
+            'dpi': 150,
+            'jpeg_quality': 75
+        }
 
     def check_pillow(self):
         try:
@@ -38,6 +104,9 @@ class ReportGenerator:
             return False
 
     def generateReport(self):
+        if self.results is not None:
+            MessageUtils.showErrorMessage(self.parent, "正在生成报告，请等待当前报告完成")
+            return
         if not self.parent.result_paths:
             MessageUtils.showErrorMessage(self.parent, "没有可生成报告的结果")
             return
@@ -47,31 +116,45 @@ class ReportGenerator:
         msg_box.setText("请选择报告格式:")
 
         pdf_btn = msg_box.addButton("PDF格式", QMessageBox.ActionRole)
+        large_pdf_btn = msg_box.addButton("PDF(大报告)", QMessageBox.ActionRole)
         html_btn = msg_box.addButton("HTML格式", QMessageBox.ActionRole)
+        html_assets_btn = msg_box.addButton("HTML(图片外置)", QMessageBox.ActionRole)
         img_btn = msg_box.addButton("图片格式", QMessageBox.ActionRole)
+        tiled_img_btn = msg_box.addButton("图片(分页)", QMessageBox.ActionRole)
         separate_img_btn = msg_box.addButton("单独图片", QMessageBox.ActionRole)
-        cancel_btn = msg_box.addButton("取消", QMessageBox.RejectRole)
+        msg_box.addButton("取消", QMessageBox.RejectRole)
 
         msg_box.exec_()
 
-        if msg_box.clickedButton() == cancel_btn:
+        exports = {
+            pdf_btn: lambda: self.generatePDFReport(self.getReportFilePath("pdf")),
+            large_pdf_btn: lambda: self.generateLargePDFReport(self.getReportFilePath("pdf")),
+            html_btn: lambda: self.generateHTMLReport(self.getReportFilePath("html")),
+            html_assets_btn: lambda: self.generateHTMLReport(self.getReportFilePath("html"), external_assets=True),
+            img_btn: lambda: self.generateImageReport(self.getReportFilePath("png")),
+            tiled_img_btn: lambda: self.generateTiledImageReport(self.getReportFilePath("sheets")),
+            separate_img_btn: self.generateSeparateImages,
+        }
+        export = exports.get(msg_box.clickedButton())
+        if export is None:
             return
-        elif msg_box.clickedButton() == pdf_btn:
-            self.generatePDFReport(self.getReportFilePath("pdf"))
-        elif msg_box.clickedButton() == html_btn:
-            self.generateHTMLReport(self.getReportFilePath("html"))
-        elif msg_box.clickedButton() == img_btn:
-            self.generateImageReport(self.getReportFilePath("png"))
-        elif msg_box.clickedButton() == separate_img_btn:
-            self.generateSeparateImages()
+        # 导出期间界面仍处理事件，各导出方法只使用这份结果副本
+        self.results = ResultSnapshot(self.parent)
+        try:
+            export()
+        finally:
+            self.results = None
 
     def getReportFilePath(self, extension):
         default_name = f"CAD检索报告_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
         file_filter = {
             "pdf": "PDF文件 (*.pdf)",
             "html": "HTML文件 (*.html)",
-            "png": "PNG图片 (*.png)"
+            "png": "PNG图片 (*.png)",
+            "sheets": "PNG图片 (*.png);;WebP图片 (*.webp)"
         }.get(extension, "所有文件 (*.*)")
+        if extension == "sheets":
+            extension = "png"
 
         file_path, _ = QFileDialog.getSaveFileName(
             self.parent,
@@ -123,18 +206,21 @@ class ReportGenerator:
         try:
             # 保存查询模型图片
             query_path = os.path.join(save_dir, "query_model.png")
-            if self.saveAndResizeCanvasScreenshot(self.parent.mainCanvas, query_path):
+            query_img = self.queryImage()
+            if query_img is not None:
+                self.resizeImage(query_img).save(query_path)
                 self.parent.logMessage(f"已保存查询模型图片: {query_path}")
 
-            # 保存结果图片
-            for i, (path, score, result_class) in enumerate(zip(
-                    self.parent.result_paths, self.parent.result_scores, self.parent.result_classes)):
-                canvas_idx = i % 8
-                canvas = self.parent.canvases[canvas_idx]
+            # 保存结果图片，图片边渲染边写入
+            for i, (path, score, result_class, data) in enumerate(zip(
+                    self.results.paths, self.results.scores, self.results.classes,
+                    self.resultImageStream())):
                 img_name = f"result_{i + 1}_{result_class}_{score:.2f}percent.png"
                 dest_path = os.path.join(save_dir, img_name)
 
-                if self.saveAndResizeCanvasScreenshot(canvas, dest_path):
+                result_img = self.decodeImage(data)
+                if result_img is not None:
+                    self.resizeImage(result_img).save(dest_path)
                     self.parent.logMessage(f"已保存结果图片: {dest_path}")
 
             # 打开保存目录
@@ -144,56 +230,88 @@ class ReportGenerator:
         except Exception as e:
             MessageUtils.showErrorMessage(self.parent, f"保存图片时出错: {str(e)}")
 
-    def saveAndResizeCanvasScreenshot(self, canvas, file_path):
-        """保存并调整画布截图尺寸"""
-        try:
-            from PIL import Image as PILImage
-
-            # 先保存原始截图
-            temp_path = os.path.join(self.parent.temp_dir, "temp_screenshot.png")
-            if not self.saveCanvasScreenshot(canvas, temp_path):
-                return False
-
-            # 打开并调整尺寸
-            img = PILImage.open(temp_path)
-            img = img.resize((self.image_settings['width'], self.image_settings['height']), PILImage.LANCZOS)
-            img.save(file_path)
-
-            # 删除临时文件
-            try:
-                os.remove(temp_path)
-            except:
-                pass
+    def grabCanvasImage(self, canvas):
+        """直接把视图的帧缓冲读入内存，返回PIL图像；视图不存在或读取失败时返回None"""
+        from PIL import Image as PILImage
 
-            return True
+        if canvas is None:
+            return None
+        width, height = max(canvas.width(), 1), max(canvas.height(), 1)
+        try:
+            data = canvas._display.GetImageData(width, height, Graphic3d_BufferType.Graphic3d_BT_RGB)
+            # 每行可能按4字节对齐；OpenGL帧缓冲的行序自下而上
+            stride = len(data) // height
+            image = PILImage.frombuffer('RGB', (width, height), data, 'raw', 'RGB', stride, -1)
+            return image.copy()
         except Exception as e:
-            self.parent.logMessage(f"调整图片尺寸时出错: {str(e)}")
-            return False
+            self.parent.logMessage(f"读取视图图像失败: {str(e)}")
+            return None
 
-    def saveCanvasScreenshot(self, canvas, file_path):
-        """直接保存画布截图，不添加任何额外内容"""
-        max_retries = 3
-        retry_delay = 0.5
+    def queryImage(self):
+        return self.grabCanvasImage(self.parent.mainCanvas)
 
-        for attempt in range(max_retries):
-            try:
-                # 确保目录存在
-                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    def resultColor(self, index):
+        matched = self.results.classes[index] == self.results.current_class
+        color = self.results.correct_color if matched else self.results.incorrect_color
+        return color.Red(), color.Green(), color.Blue()
 
-                # 保存截图
-                view = canvas._display.View
-                view.Dump(file_path, Graphic3d_BufferType.Graphic3d_BT_RGB)
+    def reportSize(self):
+        return self.image_settings['width'], self.image_settings['height']
 
-                # 验证文件是否创建成功
-                if os.path.exists(file_path) and os.path.getsize(file_path) > 0:
-                    return True
+    def resultKey(self, index):
+        return os.path.abspath(self.results.paths[index]), self.resultColor(index), self.reportSize()
 
-            except Exception as e:
-                if attempt == max_retries - 1:  # 最后一次尝试失败
-                    self.parent.logMessage(f"无法保存图片 {file_path}: {str(e)}")
-                time.sleep(retry_delay)
+    def reportThumbnailStore(self):
+        """报告尺寸的缩略图库，尺寸设置改变后按新尺寸重新创建"""
+        if self.thumbnail_store.size != self.reportSize():
+            self.thumbnail_store = ThumbnailStore(self.thumbnail_store.store_dir, self.reportSize())
+        return self.thumbnail_store
 
-        return False
+    def readThumbnail(self, path):
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except OSError as e:
+            self.parent.logMessage(f"读取缩略图失败 {path}: {str(e)}")
+            return None
+
+    def onRenderProgress(self, done, total):
+        self.parent.progressBar.setValue(int(done * 100 / total))
+        QApplication.processEvents()
+
+    def resultImageData(self, index):
+        """离屏渲染失败时第index个结果的PNG数据: 依次使用默认尺寸的离线缩略图(thumbnail_store.py)、当前页的结果画布"""
+        fallback_store = ThumbnailStore(self.thumbnail_store.store_dir)
+        thumbnail = fallback_store.lookup(self.results.paths[index], self.resultColor(index))
+        if thumbnail:
+            data = self.readThumbnail(thumbnail)
+            if data is not None:
+                return data
+
+        # 画布只显示当前页的结果，其他页的结果没有可用的图片；导出期间结果已被替换时画布也不再对应
+        canvas_idx = index - self.parent.current_page * 8
+        if self.results.isCurrent(self.parent) and self.parent.show_3d_models and 0 <= canvas_idx < 8:
+            image = self.grabCanvasImage(self.parent.canvases[canvas_idx])
+            if image is not None:
+                return self.encodeImage(image)
+        return None
+
+    def decodeImage(self, data):
+        from PIL import Image as PILImage
+
+        if data is None:
+            return None
+        return PILImage.open(io.BytesIO(data)).convert('RGB')
+
+    def resizeImage(self, image):
+        from PIL import Image as PILImage
+
+        return image.resize((self.image_settings['width'], self.image_settings['height']), PILImage.LANCZOS)
+
+    def encodeImage(self, image, image_format='PNG'):
+        buffer = io.BytesIO()
+        image.save(buffer, image_format)
+        return buffer.getvalue()
 
     def openFolder(self, path):
         """打开保存目录"""
@@ -352,183 +470,338 @@ class ReportGenerator:
         if not file_path:
             return
 
-        report_temp_dir = os.path.join(self.parent.temp_dir, f"report_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
-        os.makedirs(report_temp_dir, exist_ok=True)
+        if not self.HAS_PILLOW:
+            MessageUtils.showErrorMessage(self.parent, "生成PDF报告需要Pillow库，请先安装(pip install pillow)")
+            return
+
+        # reportlab只在生成PDF时加载，缩短程序启动时间
+        from reportlab.lib.pagesizes import letter
+        from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image, PageBreak
+        from reportlab.lib.styles import getSampleStyleSheet
+        from reportlab.lib import colors
+        from reportlab.lib.units import inch
 
-        try:
-            doc = SimpleDocTemplate(file_path, pagesize=letter)
-            styles = getSampleStyleSheet()
-            story = []
+        doc = SimpleDocTemplate(file_path, pagesize=letter)
+        styles = getSampleStyleSheet()
+        story = []
 
-            title = Paragraph("CAD检索报告", styles['Title'])
-            story.append(title)
-            story.append(Spacer(1, 12))
+        title = Paragraph("CAD检索报告", styles['Title'])
+        story.append(title)
+        story.append(Spacer(1, 12))
 
-            story.append(Paragraph(f"<b>查询类别:</b> {self.parent.current_class}", styles['Normal']))
-            story.append(Paragraph(f"<b>检索时间:</b> {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", styles['Normal']))
-            story.append(Paragraph(f"<b>总结果数:</b> {len(self.parent.result_paths)}", styles['Normal']))
-            story.append(Spacer(1, 12))
+        story.append(Paragraph(f"<b>查询类别:</b> {self.results.current_class}", styles['Normal']))
+        story.append(Paragraph(f"<b>检索时间:</b> {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", styles['Normal']))
+        story.append(Paragraph(f"<b>总结果数:</b> {len(self.results.paths)}", styles['Normal']))
+        story.append(Spacer(1, 12))
+
+        try:
+            query_img = self.queryImage()
+            if query_img is not None:
+                img = Image(io.BytesIO(self.encodeImage(query_img)), width=6 * inch, height=4.5 * inch)
+                story.append(img)
+                story.append(Spacer(1, 12))
+            else:
+                story.append(Paragraph("无法生成查询模型截图", styles['Normal']))
+        except Exception as e:
+            self.parent.logMessage(f"生成查询模型截图时出错: {str(e)}")
+            story.append(Paragraph("查询模型截图生成失败", styles['Normal']))
+
+        story.append(Paragraph("<b>检索结果:</b>", styles['Heading2']))
+        story.append(Spacer(1, 12))
+
+        for i, (path, score, result_class, data) in enumerate(
+                zip(self.results.paths, self.results.scores, self.results.classes,
+                    self.resultImageStream())):
+            story.append(Paragraph(f"<b>结果 {i + 1}:</b>", styles['Heading3']))
+            story.append(Paragraph(f"<b>文件:</b> {os.path.basename(path)}", styles['Normal']))
+            story.append(Paragraph(f"<b>相似度:</b> {score:.2f}%", styles['Normal']))
+            story.append(Paragraph(f"<b>类别:</b> {result_class}", styles['Normal']))
+            match_status = "匹配" if result_class == self.results.current_class else "不匹配"
+            status_color = colors.green if result_class == self.results.current_class else colors.red
+            story.append(Paragraph(f"<b>匹配状态:</b> <font color='{status_color}'>{match_status}</font>",
+                                   styles['Normal']))
 
             try:
-                temp_img_path = os.path.join(report_temp_dir, f"query_{os.getpid()}.png")
-                if self.saveCanvasScreenshot(self.parent.mainCanvas, temp_img_path):
-                    img = Image(temp_img_path, width=6 * inch, height=4.5 * inch)
+                result_img = self.decodeImage(data)
+                if result_img is not None:
+                    img = Image(io.BytesIO(self.encodeImage(result_img)), width=4 * inch, height=3 * inch)
                     story.append(img)
-                    story.append(Spacer(1, 12))
                 else:
-                    story.append(Paragraph("无法生成查询模型截图", styles['Normal']))
+                    story.append(Paragraph("无法生成结果截图", styles['Normal']))
             except Exception as e:
-                self.parent.logMessage(f"生成查询模型截图时出错: {str(e)}")
-                story.append(Paragraph("查询模型截图生成失败", styles['Normal']))
+                self.parent.logMessage(f"生成结果截图时出错: {str(e)}")
+                story.append(Paragraph("结果截图生成失败", styles['Normal']))
 
-            story.append(Paragraph("<b>检索结果:</b>", styles['Heading2']))
             story.append(Spacer(1, 12))
 
-            for i, (path, score, result_class) in enumerate(
-                    zip(self.parent.result_paths, self.parent.result_scores, self.parent.result_classes)):
-                story.append(Paragraph(f"<b>结果 {i + 1}:</b>", styles['Heading3']))
-                story.append(Paragraph(f"<b>文件:</b> {os.path.basename(path)}", styles['Normal']))
-                story.append(Paragraph(f"<b>相似度:</b> {score:.2f}%", styles['Normal']))
-                story.append(Paragraph(f"<b>类别:</b> {result_class}", styles['Normal']))
-                match_status = "匹配" if result_class == self.parent.current_class else "不匹配"
-                status_color = colors.green if result_class == self.parent.current_class else colors.red
-                story.append(Paragraph(f"<b>匹配状态:</b> <font color='{status_color}'>{match_status}</font>",
-                                       styles['Normal']))
+            if i < len(self.results.paths) - 1:
+                story.append(PageBreak())
 
-                try:
-                    canvas_idx = i % 8
-                    canvas = self.parent.canvases[canvas_idx]
-
-                    temp_result_img_path = os.path.join(report_temp_dir, f"result_{os.getpid()}_{i}.png")
-                    if self.saveCanvasScreenshot(canvas, temp_result_img_path):
-                        img = Image(temp_result_img_path, width=4 * inch, height=3 * inch)
-                        story.append(img)
+        try:
+            doc.build(story)
+            self.parent.logMessage(f"PDF报告已生成: {file_path}")
+        except Exception as e:
+            MessageUtils.showErrorMessage(self.parent, f"生成PDF报告时出错: {str(e)}")
+
+    def resultImageStream(self):
+        """按结果顺序产出PNG数据
+
+        优先使用报告尺寸的离线缩略图，没有缩略图的结果边取边按批离屏渲染，用完即丢弃，不在报告之间保留。
+        """
+        keys = [self.resultKey(i) for i in range(len(self.results.paths))]
+        store = self.reportThumbnailStore()
+        thumbnails = [store.lookup(path, color) for path, color, _ in keys]
+        missing = [i for i, thumbnail in enumerate(thumbnails) if thumbnail is None]
+        # lookup计算的内容哈希写回索引，下次导出不必重新读取STEP文件
+        try:
+            store.save_index()
+        except OSError:
+            pass
+        rendered = None
+        if missing:
+            self.parent.logMessage(f"{len(keys) - len(missing)} 个结果使用缩略图, 离屏渲染 {len(missing)} 个")
+            renderer = ReportRenderer(self.reportSize())
+            rendered = renderer.render([keys[i][:2] for i in missing], self.onRenderProgress)
+        try:
+            for i, key in enumerate(keys):
+                data = self.readThumbnail(thumbnails[i]) if thumbnails[i] else None
+                if thumbnails[i] is None and rendered is not None:
+                    try:
+                        _, data, error = next(rendered)
+                    except Exception as e:
+                        # 进程池出错(如离屏OpenGL不可用)后不再使用渲染器，其余结果都改用缩略图
+                        self.parent.logMessage(f"离屏渲染出错，改用缩略图: {str(e)}")
+                        rendered = None
                     else:
-                        story.append(Paragraph("无法生成结果截图", styles['Normal']))
-                except Exception as e:
-                    self.parent.logMessage(f"生成结果截图时出错: {str(e)}")
-                    story.append(Paragraph("结果截图生成失败", styles['Normal']))
-
-                story.append(Spacer(1, 12))
-
-                if i < len(self.parent.result_paths) - 1:
-                    story.append(PageBreak())
-
-            try:
-                doc.build(story)
-                self.parent.logMessage(f"PDF报告已生成: {file_path}")
-            except Exception as e:
-                MessageUtils.showErrorMessage(self.parent, f"生成PDF报告时出错: {str(e)}")
+                        if data is None:
+                            self.parent.logMessage(f"渲染失败 {key[0]}: {error}")
+                if data is None:
+                    data = self.resultImageData(i)
+                yield data
         finally:
-            try:
-                shutil.rmtree(report_temp_dir, ignore_errors=True)
-            except Exception as e:
-                self.parent.logMessage(f"清理临时文件时出错: {str(e)}")
-
-    def generateHTMLReport(self, file_path):
+            # 导出中途出错时立即关闭渲染进程池
+            if rendered is not None:
+                rendered.close()
+            self.parent.progressBar.setValue(0)
+
+    def compressImage(self, data, width, height):
+        """按目标尺寸(像素)缩小并压缩为JPEG，返回可供reportlab读取的BytesIO"""
+        from PIL import Image as PILImage
+
+        image = PILImage.open(io.BytesIO(data)).convert('RGB')
+        image.thumbnail((width, height), PILImage.LANCZOS)
+        buffer = io.BytesIO()
+        image.save(buffer, 'JPEG', quality=self.large_pdf_settings['jpeg_quality'], optimize=True)
+        buffer.seek(0)
+        return buffer
+
+    def generateLargePDFReport(self, file_path):
+        """大结果集的PDF: 每页按网格排列多个结果，图片按目标DPI缩小并压缩为JPEG，
+        flowable在排版时逐页生成，内存占用与结果数无关"""
         if not file_path:
             return
 
-        report_temp_dir = os.path.join(self.parent.temp_dir, f"report_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
-        os.makedirs(report_temp_dir, exist_ok=True)
-
-        try:
-            html_content = f"""
-            <!DOCTYPE html>
-            <html>
-            <head>
-                <title>CAD检索报告</title>
-                <style>
-                    body {{ font-family: Arial, sans-serif; margin: 20px; }}
-                    h1 {{ color: #2c3e50; }}
-                    h2 {{ color: #3498db; border-bottom: 1px solid #eee; padding-bottom: 5px; }}
-                    h3 {{ color: #16a085; }}
-                    .result {{ margin-bottom: 20px; padding: 10px; border: 1px solid #ddd; border-radius: 5px; }}
-                    .match {{ background-color: #e8f8f5; }}
-                    .no-match {{ background-color: #fdedec; }}
-                    .info {{ margin-bottom: 5px; }}
-                    .image-container {{ margin-top: 10px; }}
-                    img {{ max-width: 600px; max-height: 450px; border: 1px solid #ddd; }}
-                </style>
-            </head>
-            <body>
-                <h1>CAD检索报告</h1>
-
-                <div class="info"><strong>查询类别:</strong> {self.parent.current_class}</div>
-                <div class="info"><strong>检索时间:</strong> {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}</div>
-                <div class="info"><strong>总结果数:</strong> {len(self.parent.result_paths)}</div>
-
-                <h2>查询模型</h2>
-                <div class="image-container">
-            """
+        if not self.HAS_PILLOW:
+            MessageUtils.showErrorMessage(self.parent, "生成PDF报告需要Pillow库，请先安装(pip install pillow)")
+            return
 
+        from reportlab.lib.pagesizes import letter
+        from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image, PageBreak, Table, TableStyle
+        from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+        from reportlab.lib import colors
+        from reportlab.lib.units import inch
+
+        settings = self.large_pdf_settings
+        columns, rows, dpi = settings['columns'], settings['rows'], settings['dpi']
+        start = time.perf_counter()
+
+        doc = SimpleDocTemplate(file_path, pagesize=letter)
+        styles = getSampleStyleSheet()
+        cell_style = ParagraphStyle('Cell', parent=styles['Normal'], fontSize=8, leading=10)
+
+        cell_width = doc.width / columns
+        image_width = cell_width - 12
+        image_height = image_width * 3 / 4
+        # 单元格内: 图片 + 3行文字 + 上下边距
+        row_height = min(image_height + 3 * cell_style.leading + 12, doc.height / rows)
+        image_pixels = (int(image_width / inch * dpi), int(image_height / inch * dpi))
+
+        def resultCell(i, data):
+            path = self.results.paths[i]
+            result_class = self.results.classes[i]
+            matched = result_class == self.results.current_class
+            cell = []
+            if data is not None:
+                cell.append(Image(self.compressImage(data, *image_pixels), width=image_width, height=image_height,
+                                  kind='proportional'))
+            else:
+                cell.append(Spacer(image_width, image_height))
+            cell.append(Paragraph(f"<b>{i + 1}.</b> {html.escape(os.path.basename(path))}", cell_style))
+            cell.append(Paragraph(f"相似度: {self.results.scores[i]:.2f}%", cell_style))
+            cell.append(Paragraph(f"类别: {html.escape(str(result_class))} - "
+                                  f"<font color='{'green' if matched else 'red'}'>{'匹配' if matched else '不匹配'}</font>",
+                                  cell_style))
+            return cell, matched
+
+        def pageTable(cells):
+            data = [[cell for cell, _ in cells[r * columns:(r + 1) * columns]]
+                    for r in range((len(cells) + columns - 1) // columns)]
+            data[-1] += [''] * (columns - len(data[-1]))
+            commands = [('GRID', (0, 0), (-1, -1), 0.5, colors.lightgrey),
+                        ('VALIGN', (0, 0), (-1, -1), 'TOP')]
+            for k, (_, matched) in enumerate(cells):
+                background = colors.HexColor('#e8f8f5' if matched else '#fdedec')
+                commands.append(('BACKGROUND', (k % columns, k // columns), (k % columns, k // columns), background))
+            return Table(data, colWidths=[cell_width] * columns, rowHeights=[row_height] * len(data),
+                         style=TableStyle(commands))
+
+        def flowables():
+            yield Paragraph("CAD检索报告", styles['Title'])
+            yield Spacer(1, 12)
+            yield Paragraph(f"<b>查询类别:</b> {html.escape(str(self.results.current_class))}", styles['Normal'])
+            yield Paragraph(f"<b>检索时间:</b> {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", styles['Normal'])
+            yield Paragraph(f"<b>总结果数:</b> {len(self.results.paths)}", styles['Normal'])
+            yield Spacer(1, 12)
             try:
-                temp_img_path = os.path.join(report_temp_dir, f"query_{os.getpid()}.png")
-                if self.saveCanvasScreenshot(self.parent.mainCanvas, temp_img_path):
-                    with open(temp_img_path, 'rb') as img_file:
-                        img_data = img_file.read()
-                    img_base64 = base64.b64encode(img_data).decode('utf-8')
-                    html_content += f'<img src="data:image/png;base64,{img_base64}" alt="查询模型">'
-                else:
-                    html_content += '<p>无法生成查询模型截图</p>'
+                query_img = self.queryImage()
             except Exception as e:
                 self.parent.logMessage(f"生成查询模型截图时出错: {str(e)}")
-                html_content += '<p>查询模型截图生成失败</p>'
+                query_img = None
+            if query_img is not None:
+                width, height = 6 * inch, 4.5 * inch
+                yield Image(self.compressImage(self.encodeImage(query_img), int(6 * dpi), int(4.5 * dpi)),
+                            width=width, height=height, kind='proportional')
+            else:
+                yield Paragraph("无法生成查询模型截图", styles['Normal'])
+
+            per_page = columns * rows
+            cells = []
+            for i, data in enumerate(self.resultImageStream()):
+                cells.append(resultCell(i, data))
+                if len(cells) == per_page:
+                    yield PageBreak()
+                    yield pageTable(cells)
+                    cells = []
+            if cells:
+                yield PageBreak()
+                yield pageTable(cells)
 
-            html_content += """
-                </div>
+        try:
+            doc.build(LazyStory(flowables()))
+        except Exception as e:
+            MessageUtils.showErrorMessage(self.parent, f"生成PDF报告时出错: {str(e)}")
+            return
+        finally:
+            self.parent.progressBar.setValue(0)
+
+        elapsed = time.perf_counter() - start
+        size_mb = os.path.getsize(file_path) / (1024 * 1024)
+        self.parent.logMessage(f"PDF报告已生成: {file_path} ({len(self.results.paths)} 个结果, "
+                               f"{doc.page} 页, {size_mb:.1f} MB, 用时 {elapsed:.1f} 秒)")
+
+    def imageSource(self, data, assets_dir=None):
+        """内嵌时返回data URI；外置时按内容哈希写入资源目录，返回相对路径"""
+        if assets_dir is None:
+            return "data:image/png;base64," + base64.b64encode(data).decode('ascii')
+        name = hashlib.sha1(data).hexdigest() + '.png'
+        asset_path = os.path.join(assets_dir, name)
+        # 相同内容的图片只写一次，同一目录下的多份报告共用
+        if not os.path.isfile(asset_path):
+            tmp_path = asset_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, asset_path)
+        return f"{os.path.basename(assets_dir)}/{name}"
+
+    def writeHTMLImage(self, f, data, alt, assets_dir):
+        if data is None:
+            f.write(f'<p>无法生成{alt}截图</p>\n')
+            return
+        src = self.imageSource(data, assets_dir)
+        f.write(f'<img src="{src}" alt="{html.escape(alt)}" loading="lazy" decoding="async">\n')
 
-                <h2>检索结果</h2>
-            """
+    def generateHTMLReport(self, file_path, external_assets=False):
+        """边生成边写入文件；external_assets为True时图片写入同目录的report_assets文件夹而不内嵌"""
+        if not file_path:
+            return
 
-            for i, (path, score, result_class) in enumerate(
-                    zip(self.parent.result_paths, self.parent.result_scores, self.parent.result_classes)):
-                match_class = "match" if result_class == self.parent.current_class else "no-match"
+        if not self.HAS_PILLOW:
+            MessageUtils.showErrorMessage(self.parent, "生成HTML报告需要Pillow库，请先安装(pip install pillow)")
+            return
 
-                html_content += f"""
-                <div class="result {match_class}">
-                    <h3>结果 {i + 1}</h3>
-                    <div class="info"><strong>文件:</strong> {os.path.basename(path)}</div>
-                    <div class="info"><strong>相似度:</strong> {score:.2f}%</div>
-                    <div class="info"><strong>类别:</strong> {result_class}</div>
-                    <div class="info"><strong>匹配状态:</strong> {'匹配' if result_class == self.parent.current_class else '不匹配'}</div>
-                    <div class="image-container">
-                """
+        assets_dir = None
+        if external_assets:
+            assets_dir = os.path.join(os.path.dirname(os.path.abspath(file_path)), HTML_ASSETS_DIR)
 
+        try:
+            if assets_dir is not None:
+                os.makedirs(assets_dir, exist_ok=True)
+            with open(file_path, 'w', encoding='utf-8') as f:
+                f.write(f"""<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="utf-8">
+    <title>CAD检索报告</title>
+    <style>
+        body {{ font-family: Arial, sans-serif; margin: 20px; }}
+        h1 {{ color: #2c3e50; }}
+        h2 {{ color: #3498db; border-bottom: 1px solid #eee; padding-bottom: 5px; }}
+        h3 {{ color: #16a085; }}
+        .result {{ margin-bottom: 20px; padding: 10px; border: 1px solid #ddd; border-radius: 5px; }}
+        .match {{ background-color: #e8f8f5; }}
+        .no-match {{ background-color: #fdedec; }}
+        .info {{ margin-bottom: 5px; }}
+        .image-container {{ margin-top: 10px; }}
+        img {{ max-width: 600px; max-height: 450px; border: 1px solid #ddd; }}
+    </style>
+</head>
+<body>
+    <h1>CAD检索报告</h1>
+
+    <div class="info"><strong>查询类别:</strong> {html.escape(str(self.results.current_class))}</div>
+    <div class="info"><strong>检索时间:</strong> {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}</div>
+    <div class="info"><strong>总结果数:</strong> {len(self.results.paths)}</div>
+
+    <h2>查询模型</h2>
+    <div class="image-container">
+""")
                 try:
-                    canvas_idx = i % 8
-                    canvas = self.parent.canvases[canvas_idx]
-
-                    temp_result_img_path = os.path.join(report_temp_dir, f"result_{os.getpid()}_{i}.png")
-                    if self.saveCanvasScreenshot(canvas, temp_result_img_path):
-                        with open(temp_result_img_path, 'rb') as img_file:
-                            img_data = img_file.read()
-                        img_base64 = base64.b64encode(img_data).decode('utf-8')
-                        html_content += f'<img src="data:image/png;base64,{img_base64}" alt="结果 {i + 1}">'
-                    else:
-                        html_content += '<p>无法生成结果截图</p>'
+                    query_img = self.queryImage()
+                    query_data = self.encodeImage(query_img) if query_img is not None else None
                 except Exception as e:
-                    self.parent.logMessage(f"生成结果截图时出错: {str(e)}")
-                    html_content += '<p>结果截图生成失败</p>'
-
-                html_content += """
-                    </div>
-                </div>
-                """
-            html_content += """
-            </body>
-            </html>
-            """
+                    self.parent.logMessage(f"生成查询模型截图时出错: {str(e)}")
+                    query_data = None
+                self.writeHTMLImage(f, query_data, "查询模型", assets_dir)
+                f.write("""    </div>
+
+    <h2>检索结果</h2>
+""")
+
+                # 图片边渲染边写入，同一时间只保留一批渲染结果
+                for i, (path, score, result_class, result_data) in enumerate(
+                        zip(self.results.paths, self.results.scores, self.results.classes,
+                            self.resultImageStream())):
+                    matched = result_class == self.results.current_class
+                    f.write(f"""    <div class="result {'match' if matched else 'no-match'}">
+        <h3>结果 {i + 1}</h3>
+        <div class="info"><strong>文件:</strong> {html.escape(os.path.basename(path))}</div>
+        <div class="info"><strong>相似度:</strong> {score:.2f}%</div>
+        <div class="info"><strong>类别:</strong> {html.escape(str(result_class))}</div>
+        <div class="info"><strong>匹配状态:</strong> {'匹配' if matched else '不匹配'}</div>
+        <div class="image-container">
+""")
+                    self.writeHTMLImage(f, result_data, f"结果 {i + 1}", assets_dir)
+                    f.write("""        </div>
+    </div>
+""")
+                f.write("""</body>
+</html>
+""")
+        except OSError as e:
+            MessageUtils.showErrorMessage(self.parent, f"生成HTML报告时出错: {str(e)}")
+            return
 
-            with open(file_path, 'w', encoding='utf-8') as f:
-                f.write(html_content)
-
-            self.parent.logMessage(f"HTML报告已生成: {file_path}")
-        finally:
-            try:
-                shutil.rmtree(report_temp_dir, ignore_errors=True)
-            except Exception as e:
-                self.parent.logMessage(f"清理临时文件时出错: {str(e)}")
+        self.parent.logMessage(f"HTML报告已生成: {file_path}")
 
     def generateImageReport(self, file_path):
         if not file_path:
@@ -545,27 +818,16 @@ class ReportGenerator:
             return
 
         try:
-            report_temp_dir = os.path.join(self.parent.temp_dir, f"report_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
-            os.makedirs(report_temp_dir, exist_ok=True)
-
-            query_img_path = os.path.join(report_temp_dir, "query.png")
-            if not self.saveCanvasScreenshot(self.parent.mainCanvas, query_img_path):
+            query_img = self.queryImage()
+            if query_img is None:
                 raise Exception("无法生成查询模型截图")
 
-            result_img_paths = []
-            for i, path in enumerate(self.parent.result_paths):
-                canvas_idx = i % 8
-                canvas = self.parent.canvases[canvas_idx]
-                img_path = os.path.join(report_temp_dir, f"result_{i}.png")
-                if self.saveCanvasScreenshot(canvas, img_path):
-                    result_img_paths.append(img_path)
-
             img_width = 800
             row_height = 200
             padding = 20
             title_height = 50
 
-            total_height = title_height + (len(self.parent.result_paths) + 1) * row_height
+            total_height = title_height + (len(self.results.paths) + 1) * row_height
 
             final_img = PILImage.new('RGB', (img_width, total_height), color=(255, 255, 255))
             draw = ImageDraw.Draw(final_img)
@@ -575,25 +837,28 @@ class ReportGenerator:
             except:
                 font = ImageFont.load_default()
 
-            title = f"CAD检索报告 - 查询: {self.parent.current_class}"
+            title = f"CAD检索报告 - 查询: {self.results.current_class}"
             draw.text((padding, padding), title, fill=(0, 0, 0), font=font)
 
-            query_img = PILImage.open(query_img_path)
             query_img = query_img.resize((img_width - 2 * padding, row_height - padding))
             final_img.paste(query_img, (padding, title_height))
             draw.text((padding, title_height + row_height - 30),
                       "查询模型", fill=(0, 0, 255), font=font)
 
-            for i, img_path in enumerate(result_img_paths):
+            # 画布高度已知，每个结果图片取到后立即贴入并释放，不同时保留全部图片
+            for i, data in enumerate(self.resultImageStream()):
+                result_img = self.decodeImage(data)
+                if result_img is None:
+                    continue
                 y_pos = title_height + (i + 1) * row_height
-                result_img = PILImage.open(img_path)
-                result_img = result_img.resize((img_width - 2 * padding, row_height - padding))
-                final_img.paste(result_img, (padding, y_pos))
-
-                info = (f"结果 {i + 1}: 相似度 {self.parent.result_scores[i]:.2f}% - "
-                        f"类别: {self.parent.result_classes[i]} - "
-                        f"{'匹配' if self.parent.result_classes[i] == self.parent.current_class else '不匹配'}")
-                text_color = (0, 128, 0) if self.parent.result_classes[i] == self.parent.current_class else (255, 0, 0)
+                with result_img:
+                    final_img.paste(result_img.resize((img_width - 2 * padding, row_height - padding)),
+                                    (padding, y_pos))
+
+                info = (f"结果 {i + 1}: 相似度 {self.results.scores[i]:.2f}% - "
+                        f"类别: {self.results.classes[i]} - "
+                        f"{'匹配' if self.results.classes[i] == self.results.current_class else '不匹配'}")
+                text_color = (0, 128, 0) if self.results.classes[i] == self.results.current_class else (255, 0, 0)
                 draw.text((padding, y_pos + row_height - 30), info, fill=text_color, font=font)
 
             final_img.save(file_path)
@@ -601,35 +866,40 @@ class ReportGenerator:
 
         except Exception as e:
             MessageUtils.showErrorMessage(self.parent, f"生成图片报告时出错: {str(e)}")
-        finally:
-            try:
-                shutil.rmtree(report_temp_dir, ignore_errors=True)
-            except Exception as e:
-                self.parent.logMessage(f"清理临时文件时出错: {str(e)}")
-
-    def saveCanvasScreenshot(self, canvas, file_path):
-        max_retries = 3
-        retry_delay = 0.5
-
-        file_path = os.path.normpath(file_path)
 
-        for attempt in range(max_retries):
-            try:
-                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    def generateTiledImageReport(self, file_path):
+        """分页图片报告: 每张图4×4个结果加一张索引图，各页在工作进程中合成"""
+        if not file_path:
+            return
 
-                abs_path = os.path.abspath(file_path)
+        if not self.HAS_PILLOW:
+            MessageUtils.showErrorMessage(self.parent, "生成图片报告需要Pillow库，请先安装(pip install pillow)")
+            return
 
-                view = canvas._display.View
-                view.Dump(abs_path, Graphic3d_BufferType.Graphic3d_BT_RGB)
+        start = time.perf_counter()
 
-                if os.path.exists(abs_path) and os.path.getsize(abs_path) > 0:
-                    return True
-                else:
-                    self.parent.logMessage(f"截图文件创建失败: {abs_path}")
+        def tiles():
+            for i, data in enumerate(self.resultImageStream()):
+                result_class = self.results.classes[i]
+                matched = result_class == self.results.current_class
+                lines = [f"{i + 1}. {os.path.basename(self.results.paths[i])}",
+                         f"相似度 {self.results.scores[i]:.2f}% - 类别: {result_class} - "
+                         f"{'匹配' if matched else '不匹配'}"]
+                yield data, lines, matched
 
-            except Exception as e:
-                self.parent.logMessage(f"截图保存失败(尝试 {attempt + 1}/{max_retries}): {str(e)}")
-                if attempt < max_retries - 1:
-                    time.sleep(retry_delay)
+        try:
+            query_img = self.queryImage()
+            query_data = self.encodeImage(query_img) if query_img is not None else None
+            header_lines = [f"查询类别: {self.results.current_class}",
+                            f"检索时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
+                            f"总结果数: {len(self.results.paths)}"]
+            paths = SheetWriter(file_path).write(tiles(), f"CAD检索报告 - 查询: {self.results.current_class}",
+                                                 header_lines, query_data)
+        except Exception as e:
+            MessageUtils.showErrorMessage(self.parent, f"生成图片报告时出错: {str(e)}")
+            return
+        finally:
+            self.parent.progressBar.setValue(0)
 
-        return False
\ No newline at end of file
+        elapsed = time.perf_counter() - start
+        self.parent.logMessage(f"图片报告已生成: {paths[0]} 等 {len(paths)} 张图片, 用时 {elapsed:.1f} 秒")
\ No newline at end of file
@@ -0,0 +1,89 @@
+import os
+import threading
+import numpy as np
+from PyQt5.QtCore import Qt, QObject, QThread, pyqtSignal
+
+from similarity_calculator import process_query, SearchCancelled
+
+# 与retrieval_service.SERVICE_ENV一致，只有设置了服务地址才导入客户端
+SERVICE_ENV = 'CAD_RETRIEVAL_SERVICE'
+
+
+class MainThreadDispatcher(QObject):
+    """通过队列连接把其他线程中的回调交给本对象所在的线程(界面线程)执行"""
+    call = pyqtSignal(object)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.call.connect(self.run, Qt.QueuedConnection)
+
+    def run(self, fn):
+        fn()
+
+    def __call__(self, fn):
+        self.call.emit(fn)
+
+
+class SearchWorker(QThread):
+    """在后台线程中执行检索，信号中带有search_id，界面据此丢弃过期的结果"""
+    progress = pyqtSignal(int, str, float)
+    succeeded = pyqtSignal(int, object, object)
+    failed = pyqtSignal(int, str)
+    cancelled = pyqtSignal(int)
+    log = pyqtSignal(str)
+
+    def __init__(self, search_id, feature_file, database_input, is_single_file, search_path,
+                 max_results, dis, nprobe, language='zh', parent=None):
+        super().__init__(parent)
+        self.search_id = search_id
+        self.feature_file = feature_file
+        self.database_input = database_input
+        self.is_single_file = is_single_file
+        self.search_path = search_path
+        self.max_results = max_results
+        self.dis = dis
+        self.nprobe = nprobe
+        self.language = language
+        self.cancel_event = threading.Event()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def isCancelled(self):
+        return self.cancel_event.is_set()
+
+    def reportProgress(self, stage, fraction):
+        # 由检索代码在各阶段之间回调，取消后抛出异常中止计算
+        if self.cancel_event.is_set():
+            raise SearchCancelled()
+        self.progress.emit(self.search_id, stage, float(fraction))
+
+    def run(self):
+        try:
+            self.reportProgress('loading', 0)
+            input_features = np.load(self.feature_file, allow_pickle=True)
+            paths, scores = self.runQuery(input_features)
+            if self.cancel_event.is_set():
+                raise SearchCancelled()
+        except SearchCancelled:
+            self.cancelled.emit(self.search_id)
+        except Exception as e:
+            self.failed.emit(self.search_id, str(e))
+        else:
+            self.succeeded.emit(self.search_id, list(paths), list(scores))
+
+    def runQuery(self, input_features):
+        """设置了检索服务地址时使用共享的常驻服务，连接失败则在本地检索"""
+        if os.environ.get(SERVICE_ENV):
+            from retrieval_service import RetrievalClient
+
+            try:
+                self.reportProgress('scoring', 0)
+                return RetrievalClient().process_query(
+                    input_features, self.database_input, self.search_path, self.is_single_file,
+                    k=self.max_results, dis=self.dis, nprobe=self.nprobe)
+            except OSError as e:
+                self.log.emit(f"检索服务不可用，改为本地检索: {str(e)}" if self.language == 'zh'
+                              else f"Retrieval service unavailable, searching locally: {str(e)}")
+        return process_query(input_features, self.database_input, self.search_path, self.is_single_file,
+                             k=self.max_results, dis=self.dis, nprobe=self.nprobe, progress=self.reportProgress)
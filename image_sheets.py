@@ -0,0 +1,164 @@
+"""分页的图片报告
+
+结果按固定网格(默认4×4)分成多张同样大小的图片，另有一张索引图列出查询信息和各页的结果范围。
+每张图在工作进程中合成并编码，主进程同时只保留几页待处理的图片数据，内存占用与结果总数无关。
+"""
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from report_renderer import default_workers
+
+SHEET_COLUMNS = 4
+SHEET_ROWS = 4
+TILE_SIZE = (320, 240)
+CAPTION_HEIGHT = 56
+PADDING = 10
+TITLE_HEIGHT = 50
+INDEX_LINE_HEIGHT = 24
+BACKGROUND = (255, 255, 255)
+MATCH_COLOR = (0, 128, 0)
+MISMATCH_COLOR = (255, 0, 0)
+
+
+def load_font(size):
+    from PIL import ImageFont
+
+    try:
+        return ImageFont.truetype("arial.ttf", size)
+    except OSError:
+        return ImageFont.load_default()
+
+
+def sheet_format(path):
+    return 'WEBP' if path.lower().endswith('.webp') else 'PNG'
+
+
+def save_sheet(image, out_path):
+    image_format = sheet_format(out_path)
+    options = {'quality': 85, 'method': 4} if image_format == 'WEBP' else {'optimize': True}
+    tmp_path = out_path + '.tmp'
+    image.save(tmp_path, image_format, **options)
+    os.replace(tmp_path, out_path)
+
+
+def compose_sheet(out_path, title, tiles, columns=SHEET_COLUMNS, rows=SHEET_ROWS, tile_size=TILE_SIZE):
+    """在工作进程中合成一页
+
+    tiles为[(PNG字节或None, 说明文字行, 是否匹配)]，不足一页的位置留白，每页大小相同。
+    """
+    from PIL import Image as PILImage, ImageDraw
+
+    cell_width = tile_size[0] + PADDING
+    cell_height = tile_size[1] + CAPTION_HEIGHT + PADDING
+    sheet = PILImage.new('RGB', (columns * cell_width + PADDING, TITLE_HEIGHT + rows * cell_height),
+                         color=BACKGROUND)
+    draw = ImageDraw.Draw(sheet)
+    title_font = load_font(24)
+    caption_font = load_font(14)
+    draw.text((PADDING, PADDING), title, fill=(0, 0, 0), font=title_font)
+
+    for k, (data, lines, matched) in enumerate(tiles[:columns * rows]):
+        x = PADDING + (k % columns) * cell_width
+        y = TITLE_HEIGHT + (k // columns) * cell_height
+        if data is not None:
+            with PILImage.open(io.BytesIO(data)) as tile:
+                tile = tile.convert('RGB')
+                tile.thumbnail(tile_size, PILImage.LANCZOS)
+                # 保持比例居中
+                sheet.paste(tile, (x + (tile_size[0] - tile.width) // 2, y + (tile_size[1] - tile.height) // 2))
+        text_color = MATCH_COLOR if matched else MISMATCH_COLOR
+        draw.rectangle((x - 1, y - 1, x + tile_size[0], y + tile_size[1]), outline=text_color)
+        for n, line in enumerate(lines):
+            draw.text((x, y + tile_size[1] + 4 + n * 17), line, fill=text_color, font=caption_font)
+
+    save_sheet(sheet, out_path)
+    return out_path
+
+
+def compose_index(out_path, title, header_lines, query_data, pages, width=None):
+    """索引页: 查询信息、查询模型图片和每页的结果范围，pages为[(文件名, 起始序号, 结束序号, 匹配数)]"""
+    from PIL import Image as PILImage, ImageDraw
+
+    width = width or SHEET_COLUMNS * (TILE_SIZE[0] + PADDING) + PADDING
+    query_size = (TILE_SIZE[0] * 2, TILE_SIZE[1] * 2)
+    height = (TITLE_HEIGHT + len(header_lines) * INDEX_LINE_HEIGHT + query_size[1] + 2 * PADDING
+              + (len(pages) + 1) * INDEX_LINE_HEIGHT + PADDING)
+    sheet = PILImage.new('RGB', (width, height), color=BACKGROUND)
+    draw = ImageDraw.Draw(sheet)
+    font = load_font(16)
+    draw.text((PADDING, PADDING), title, fill=(0, 0, 0), font=load_font(24))
+
+    y = TITLE_HEIGHT
+    for line in header_lines:
+        draw.text((PADDING, y), line, fill=(0, 0, 0), font=font)
+        y += INDEX_LINE_HEIGHT
+    if query_data is not None:
+        with PILImage.open(io.BytesIO(query_data)) as query:
+            query = query.convert('RGB')
+            query.thumbnail(query_size, PILImage.LANCZOS)
+            sheet.paste(query, (PADDING, y + PADDING))
+    y += query_size[1] + 2 * PADDING
+
+    draw.text((PADDING, y), "页面 / 结果范围 / 匹配数", fill=(0, 0, 255), font=font)
+    for name, first, last, matched in pages:
+        y += INDEX_LINE_HEIGHT
+        draw.text((PADDING, y), f"{name}    {first} - {last}    {matched}/{last - first + 1}",
+                  fill=(0, 0, 0), font=font)
+
+    save_sheet(sheet, out_path)
+    return out_path
+
+
+class SheetWriter:
+    """把结果流按页分组，提交给进程池合成；待处理的页数超过max_pending时等待最早的一页完成"""
+
+    def __init__(self, file_path, columns=SHEET_COLUMNS, rows=SHEET_ROWS, tile_size=TILE_SIZE,
+                 workers=None, max_pending=None):
+        root, ext = os.path.splitext(file_path)
+        self.root = root
+        self.ext = ext.lower() if ext.lower() in ('.png', '.webp') else '.png'
+        self.columns = columns
+        self.rows = rows
+        self.tile_size = tuple(tile_size)
+        self.workers = workers or default_workers()
+        self.max_pending = max_pending or self.workers * 2
+
+    def sheet_path(self, number):
+        return f"{self.root}_{number:03d}{self.ext}"
+
+    @property
+    def index_path(self):
+        return f"{self.root}_index{self.ext}"
+
+    def write(self, tiles, title, header_lines, query_data=None):
+        """tiles为逐个产出的(PNG字节或None, 说明文字行, 是否匹配)，返回[索引页路径, 各页路径...]"""
+        per_sheet = self.columns * self.rows
+        pages = []
+        paths = []
+        pending = []
+        with ProcessPoolExecutor(self.workers) as pool:
+            def submit(batch):
+                number = len(pages) + 1
+                out_path = self.sheet_path(number)
+                first = (number - 1) * per_sheet + 1
+                pages.append((os.path.basename(out_path), first, first + len(batch) - 1,
+                              sum(1 for tile in batch if tile[2])))
+                pending.append(pool.submit(compose_sheet, out_path, f"{title} - 第 {number} 页", batch,
+                                           self.columns, self.rows, self.tile_size))
+                while len(pending) >= self.max_pending:
+                    paths.append(pending.pop(0).result())
+
+            batch = []
+            for tile in tiles:
+                batch.append(tile)
+                if len(batch) == per_sheet:
+                    submit(batch)
+                    batch = []
+            if batch:
+                submit(batch)
+
+            index = pool.submit(compose_index, self.index_path, title, header_lines, query_data, pages)
+            paths.extend(future.result() for future in pending)
+            paths.insert(0, index.result())
+        return paths
@@ -0,0 +1,257 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+from similarity_calculator import (batch_distance, select_top_k, l2_normalize, euclidean_gram_distance,
+                                   normalize_by_range)
+
+IVF_VERSION = 1
+IVF_SUFFIX = '.ivf'
+
+
+def assign_clusters(data, centroids, block_size=65536):
+    # |x-c|^2 = |x|^2 + |c|^2 - 2xc，|x|^2对每行是常数，比较时可以省略
+    c_sq = (centroids * centroids).sum(axis=1)
+    assign = np.empty(len(data), dtype=np.int64)
+    for start in range(0, len(data), block_size):
+        block = np.asarray(data[start:start + block_size], dtype=np.float32)
+        scores = block @ centroids.T
+        scores *= -2
+        scores += c_sq[None, :]
+        assign[start:start + block_size] = scores.argmin(axis=1)
+    return assign
+
+
+def kmeans(data, n_clusters, n_iter=20, seed=0, sample_size=100000, progress=None):
+    """NumPy实现的k-means，大数据集只在随机子集上训练；每次迭代后回调progress，回调中可抛出异常中止训练"""
+    rng = np.random.default_rng(seed)
+    if sample_size and len(data) > sample_size:
+        train = np.asarray(data[np.sort(rng.choice(len(data), sample_size, replace=False))], dtype=np.float32)
+    else:
+        train = np.asarray(data, dtype=np.float32)
+
+    n_clusters = min(n_clusters, len(train))
+    centroids = train[rng.choice(len(train), n_clusters, replace=False)].copy()
+    for iteration in range(n_iter):
+        if progress:
+            progress('scoring', iteration / n_iter)
+        assign = assign_clusters(train, centroids)
+        counts = np.bincount(assign, minlength=n_clusters)
+        sums = np.zeros_like(centroids)
+        for d in range(train.shape[1]):
+            sums[:, d] = np.bincount(assign, weights=train[:, d], minlength=n_clusters)
+
+        empty = counts == 0
+        counts[empty] = 1
+        new_centroids = sums / counts[:, None]
+        # 空簇重新随机选取中心
+        if empty.any():
+            new_centroids[empty] = train[rng.choice(len(train), int(empty.sum()), replace=False)]
+        if np.allclose(new_centroids, centroids):
+            centroids = new_centroids.astype(np.float32)
+            break
+        centroids = new_centroids.astype(np.float32)
+    return centroids
+
+
+def default_n_lists(rows):
+    return max(1, min(int(4 * np.sqrt(rows)), 65536))
+
+
+def fingerprint_digest(fingerprint):
+    return hashlib.sha1(repr(fingerprint).encode('utf-8')).hexdigest()
+
+
+def ivf_index_path(database_input):
+    # 索引放在数据库文件/目录旁边，避免修改特征目录本身
+    return os.path.normpath(database_input) + IVF_SUFFIX
+
+
+class IVFIndex:
+    """倒排文件(IVF)近似检索索引: 数据库按最近的聚类中心分桶，查询只扫描nprobe个桶"""
+
+    def __init__(self, centroids, offsets, order, vectors, sq_norms, meta=None):
+        self.centroids = centroids
+        self.offsets = offsets
+        self.order = order
+        self.vectors = vectors
+        self.sq_norms = sq_norms
+        self.meta = meta or {}
+
+    @classmethod
+    def build(cls, features, n_lists=None, n_iter=20, seed=0, source_digest=None, progress=None):
+        """features应为已做L2归一化的float32矩阵"""
+        features = np.asarray(features, dtype=np.float32)
+        n_lists = n_lists or default_n_lists(len(features))
+        centroids = kmeans(features, n_lists, n_iter, seed, progress=progress)
+        assign = assign_clusters(features, centroids)
+
+        # 按聚类编号重排，使每个桶在内存中连续
+        order = np.argsort(assign, kind='stable')
+        counts = np.bincount(assign, minlength=len(centroids))
+        offsets = np.zeros(len(centroids) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        vectors = features[order]
+        sq_norms = (vectors * vectors).sum(axis=1)
+        meta = {
+            'version': IVF_VERSION,
+            'rows': len(features),
+            'dim': features.shape[1],
+            'n_lists': len(centroids),
+            'source_digest': source_digest,
+        }
+        return cls(centroids, offsets, order, vectors, sq_norms, meta)
+
+    @property
+    def source_digest(self):
+        return self.meta.get('source_digest')
+
+    def __len__(self):
+        return len(self.order)
+
+    def save(self, index_dir):
+        """先写入同级的临时目录再整体替换，读取方不会看到新旧文件混合的索引"""
+        index_dir = os.path.abspath(index_dir)
+        tmp_dir = tempfile.mkdtemp(prefix=os.path.basename(index_dir) + '.', suffix='.tmp',
+                                   dir=os.path.dirname(index_dir))
+        old_dir = tmp_dir + '.old'
+        try:
+            for name in ('centroids', 'offsets', 'order', 'vectors', 'sq_norms'):
+                np.save(os.path.join(tmp_dir, f'{name}.npy'), getattr(self, name))
+            with open(os.path.join(tmp_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+                json.dump(self.meta, f)
+            # 目录不能直接覆盖已存在的目录，先把旧索引移开
+            try:
+                os.replace(index_dir, old_dir)
+            except FileNotFoundError:
+                pass
+            try:
+                os.replace(tmp_dir, index_dir)
+            except OSError:
+                # 另一个进程刚好写入了同一数据库的索引，保留对方的
+                if not os.path.isdir(index_dir):
+                    raise
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            shutil.rmtree(old_dir, ignore_errors=True)
+
+    @classmethod
+    def load(cls, index_dir):
+        """读取已保存的索引，数据部分以内存映射方式打开；不存在或格式不符时返回None"""
+        meta_path = os.path.join(index_dir, 'meta.json')
+        if not os.path.isfile(meta_path):
+            return None
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta.get('version') != IVF_VERSION:
+                return None
+            arrays = {name: np.load(os.path.join(index_dir, f'{name}.npy'), mmap_mode='r')
+                      for name in ('order', 'vectors', 'sq_norms')}
+            centroids = np.load(os.path.join(index_dir, 'centroids.npy'))
+            offsets = np.load(os.path.join(index_dir, 'offsets.npy'))
+        except (OSError, ValueError):
+            return None
+        # 读取过程中索引被替换时各文件可能不配套，按meta校验形状
+        if (len(centroids) != meta.get('n_lists') or len(offsets) != len(centroids) + 1
+                or len(arrays['vectors']) != meta.get('rows') or len(arrays['order']) != meta.get('rows')):
+            return None
+        return cls(centroids, offsets, arrays['order'], arrays['vectors'], arrays['sq_norms'], meta)
+
+    def probe(self, x, nprobe):
+        nprobe = max(1, min(int(nprobe), len(self.centroids)))
+        c_sq = (self.centroids * self.centroids).sum(axis=1)
+        scores = x @ self.centroids.T
+        scores *= -2
+        scores += c_sq[None, :]
+        return select_top_k(scores, nprobe)[0]
+
+    def list_rows(self, lists):
+        return np.concatenate([np.arange(self.offsets[c], self.offsets[c + 1]) for c in lists])
+
+    def raw_distances(self, query, rows):
+        return euclidean_gram_distance(query[None, :], np.asarray(self.vectors[rows]),
+                                       np.asarray(self.sq_norms[rows]))
+
+    def search(self, x, k=None, nprobe=8, dis='euclidean', l2=True):
+        """返回每个查询的(原始行号, 归一化距离)，候选数可能少于k
+
+        欧氏距离与精确检索一样按整个数据库的最小/最大距离归一化，但范围是估计值:
+        最小值取自探测的候选；单位向量离q最远的点即离-q最近的点，最大值由对-q再探测nprobe个桶得到。
+        最近和最远的点都落在探测的桶中时，得分与精确检索相同。
+        """
+        x = np.atleast_2d(np.array(x, dtype=np.float32))
+        if l2:
+            x = l2_normalize(x, copy=False)
+        far_lists = self.probe(-x, nprobe) if dis == 'euclidean' and l2 else None
+
+        indices = []
+        scores = []
+        for i, (query, lists) in enumerate(zip(x, self.probe(x, nprobe))):
+            rows = self.list_rows(lists)
+            if len(rows) == 0:
+                indices.append(np.zeros(0, dtype=np.int64))
+                scores.append(np.zeros(0, dtype=np.float32))
+                continue
+            if dis == 'euclidean':
+                distances = self.raw_distances(query, rows)
+                min_distance = distances.min(axis=1)
+                max_distance = distances.max(axis=1)
+                if far_lists is not None:
+                    far_rows = self.list_rows(far_lists[i])
+                    if len(far_rows):
+                        np.maximum(max_distance, self.raw_distances(query, far_rows).max(axis=1), out=max_distance)
+                distances = normalize_by_range(distances, min_distance, max_distance)
+            else:
+                candidates = np.asarray(self.vectors[rows])
+                distances = batch_distance(query[None, :], candidates, np.asarray(self.sq_norms[rows]), dis)
+            index, score = select_top_k(distances, k)
+            indices.append(np.asarray(self.order[rows[index[0]]]))
+            scores.append(score[0])
+        return indices, scores
+
+
+def load_saved_ivf_index(database_input, fingerprint, rows):
+    """读取与数据库匹配的已保存索引，不存在或已过期时返回None；不需要读取数据库特征"""
+    if not database_input or fingerprint is None:
+        return None
+    index = IVFIndex.load(ivf_index_path(database_input))
+    if index is not None and index.source_digest == fingerprint_digest(fingerprint) and len(index) == rows:
+        return index
+    return None
+
+
+def build_ivf_index(features, database_input=None, fingerprint=None, n_lists=None, log=None, progress=None):
+    """重新训练索引，有数据库路径时保存到数据库旁边"""
+    digest = fingerprint_digest(fingerprint) if fingerprint is not None else None
+    index_dir = ivf_index_path(database_input) if database_input else None
+
+    index = IVFIndex.build(features, n_lists, source_digest=digest, progress=progress)
+    if index_dir and digest:
+        try:
+            index.save(index_dir)
+        except OSError as e:
+            if log:
+                log(f"无法保存IVF索引 {index_dir}: {e}")
+    return index
+
+
+def load_or_build_ivf_index(features, database_input=None, fingerprint=None, n_lists=None, log=None, progress=None):
+    """加载与数据库匹配的已保存索引，否则重新训练并保存"""
+    index = load_saved_ivf_index(database_input, fingerprint, len(features))
+    if index is not None:
+        return index
+    return build_ivf_index(features, database_input, fingerprint, n_lists, log, progress)
+
+
+def recall_at_k(exact_indices, approx_indices):
+    """近似结果对精确前k个结果的召回率"""
+    hits = 0
+    total = 0
+    for exact, approx in zip(exact_indices, approx_indices):
+        hits += len(set(np.asarray(exact).tolist()) & set(np.asarray(approx).tolist()))
+        total += len(exact)
+    return hits / total if total else 1.0
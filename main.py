@@ -1,9 +1,40 @@
 import os
 import sys
-from gui_core import CADRetrievalApp
-from PyQt5.QtWidgets import QApplication
+import multiprocessing
+from contextlib import nullcontext
 
 if __name__ == "__main__":
-    app = QApplication(sys.argv)
-    ex = CADRetrievalApp()
+    # 打包后的程序启动预读/转换子进程时需要
+    multiprocessing.freeze_support()
+
+    # --profile-startup: 统计各模块导入和初始化耗时，窗口显示后输出
+    profiler = None
+    if '--profile-startup' in sys.argv:
+        sys.argv.remove('--profile-startup')
+        from startup_profiler import StartupProfiler
+        profiler = StartupProfiler()
+        profiler.install()
+
+    def stage(name):
+        return profiler.stage(name) if profiler else nullcontext()
+
+    with stage("导入PyQt5"):
+        from PyQt5.QtWidgets import QApplication
+        from PyQt5.QtCore import QTimer
+    with stage("导入gui_core"):
+        from gui_core import CADRetrievalApp
+
+    with stage("创建QApplication"):
+        app = QApplication(sys.argv)
+    with stage("创建主窗口"):
+        ex = CADRetrievalApp()
+
+    if profiler:
+        def finish_profile():
+            profiler.uninstall()
+            path = profiler.write_report()
+            ex.logMessage(f"启动耗时分析已保存: {path}")
+
+        # 事件循环开始处理后窗口已完成第一次绘制
+        QTimer.singleShot(0, finish_profile)
     sys.exit(app.exec_())
\ No newline at end of file
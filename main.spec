@@ -17,7 +17,8 @@ a = Analysis(
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
-    excludes=[],
+    # torch仅作为余弦距离的可选后端，打包时排除以减小体积
+    excludes=['torch'],
     noarchive=False,
     optimize=0,
 )
@@ -0,0 +1,94 @@
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from brep_cache import brep_cache, warm_file
+from shape_cache import shape_cache
+
+
+class PagePrefetcher:
+    """在后台预读相邻结果页的模型
+
+    STEP解析和网格剖分放在工作进程中完成(写入BRep磁盘缓存)，不占用界面线程；
+    转换完成后再把二进制模型读入内存缓存，翻页时直接命中。
+    dispatch(fn)把读取交给使用缓存的线程执行(如界面线程)，为None时在进程池的回调线程中直接读取。
+    """
+
+    def __init__(self, cache=shape_cache, disk_cache=brep_cache, workers=2, max_queue=16, level='coarse',
+                 dispatch=None):
+        self.cache = cache
+        self.dispatch = dispatch
+        self.disk_cache = disk_cache
+        self.workers = workers
+        self.max_queue = max_queue
+        self.level = level
+        self.pool = None
+        self.queue = deque()
+        self.running = {}
+        self.generation = 0
+        # 取消future时会同步触发回调，需要可重入锁
+        self.lock = threading.RLock()
+
+    def executor(self):
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(self.workers)
+        return self.pool
+
+    def prefetch(self, paths):
+        """用新的路径列表替换待预读队列，已在内存缓存或正在预读的模型跳过"""
+        with self.lock:
+            self.queue.clear()
+            running = {path for _, path in self.running.values()}
+            for path in paths:
+                if len(self.queue) >= self.max_queue:
+                    break
+                if path in running or path in self.queue or self.cache.contains(path, self.level):
+                    continue
+                self.queue.append(path)
+            self.submit_next()
+
+    def submit_next(self):
+        # 调用方需持有锁
+        while self.queue and len(self.running) < self.workers:
+            path = self.queue.popleft()
+            future = self.executor().submit(warm_file, self.disk_cache.cache_dir, path, (self.level,))
+            self.running[future] = (self.generation, path)
+            future.add_done_callback(self.on_done)
+
+    def on_done(self, future):
+        with self.lock:
+            generation, path = self.running.pop(future, (None, None))
+            current = generation == self.generation
+            if self.pool is not None:
+                self.submit_next()
+        if not current or future.cancelled() or future.exception() is not None or future.result()[1] is not None:
+            return
+        # 回调运行在进程池的管理线程中，读取BRep文件交给dispatch指定的线程
+        if self.dispatch is not None:
+            self.dispatch(lambda: self.load(generation, path))
+        else:
+            self.load(generation, path)
+
+    def load(self, generation, path):
+        if generation != self.generation:
+            return
+        try:
+            self.cache.get(path, self.level)
+        except Exception:
+            # 预读失败时在真正显示该页时再报告错误
+            pass
+
+    def cancel(self):
+        """新的检索开始时清空队列，已在运行的任务结果被丢弃"""
+        with self.lock:
+            self.generation += 1
+            self.queue.clear()
+            for future in list(self.running):
+                future.cancel()
+
+    def shutdown(self):
+        self.cancel()
+        with self.lock:
+            pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
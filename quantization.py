@@ -0,0 +1,143 @@
+import numpy as np
+
+from similarity_calculator import l2_normalize, merge_top_k, normalize_by_range
+
+QUANTIZATION_MODES = ('float16', 'int8')
+
+
+class ScalarQuantizer:
+    """逐维标量量化: int8模式按每一维的最小值(offset)和步长(scale)编码为8位整数"""
+
+    def __init__(self, mode, offset, scale):
+        if mode not in QUANTIZATION_MODES:
+            raise ValueError(f"不支持的量化方式: {mode}")
+        self.mode = mode
+        self.offset = offset.astype(np.float32)
+        self.scale = scale.astype(np.float32)
+
+    @classmethod
+    def fit(cls, blocks, dim, mode='int8'):
+        if mode == 'float16':
+            return cls(mode, np.zeros(dim, dtype=np.float32), np.ones(dim, dtype=np.float32))
+        lower = np.full(dim, np.inf, dtype=np.float32)
+        upper = np.full(dim, -np.inf, dtype=np.float32)
+        for block in blocks:
+            np.minimum(lower, block.min(axis=0), out=lower)
+            np.maximum(upper, block.max(axis=0), out=upper)
+        scale = (upper - lower) / 255
+        scale[scale == 0] = 1
+        return cls(mode, lower, scale)
+
+    @property
+    def code_dtype(self):
+        return np.float16 if self.mode == 'float16' else np.uint8
+
+    def encode(self, block):
+        if self.mode == 'float16':
+            return block.astype(np.float16)
+        codes = np.rint((block - self.offset) / self.scale)
+        return np.clip(codes, 0, 255).astype(np.uint8)
+
+    def decode(self, codes):
+        return codes.astype(np.float32) * self.scale + self.offset
+
+
+class QuantizedMatrix:
+    """量化后的数据库矩阵，先用压缩编码粗筛，再用全精度数据对候选重排"""
+
+    def __init__(self, quantizer, codes, sq_norms):
+        self.quantizer = quantizer
+        self.codes = codes
+        self.sq_norms = sq_norms
+
+    @classmethod
+    def build(cls, source, mode='int8', l2=True, block_size=65536):
+        rows, dim = source.shape
+
+        def normalized_blocks():
+            for start in range(0, rows, block_size):
+                block = np.array(source[start:start + block_size], dtype=np.float32)
+                yield l2_normalize(block, copy=False) if l2 else block
+
+        quantizer = ScalarQuantizer.fit(normalized_blocks(), dim, mode)
+        codes = np.empty((rows, dim), dtype=quantizer.code_dtype)
+        sq_norms = np.empty(rows, dtype=np.float32)
+        for start, block in zip(range(0, rows, block_size), normalized_blocks()):
+            block_codes = quantizer.encode(block)
+            codes[start:start + len(block)] = block_codes
+            # 粗筛使用解码后向量的范数，保证距离公式自洽
+            decoded = quantizer.decode(block_codes)
+            sq_norms[start:start + len(block)] = (decoded * decoded).sum(axis=1)
+        return cls(quantizer, codes, sq_norms)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.sq_norms.nbytes
+
+    def __len__(self):
+        return len(self.codes)
+
+    def approximate_distance(self, x, start, stop, dis):
+        # x·y ≈ (x*scale)·code + x·offset，只需把编码转换为float32后做一次矩阵乘法
+        block = self.codes[start:stop].astype(np.float32)
+        gram = (x * self.quantizer.scale) @ block.T
+        gram += (x @ self.quantizer.offset)[:, None]
+        if dis == 'cos':
+            np.subtract(1, gram, out=gram)
+            return gram
+        gram *= -2
+        gram += (x * x).sum(axis=1)[:, None]
+        gram += self.sq_norms[None, start:stop]
+        np.maximum(gram, 0, out=gram)
+        np.sqrt(gram, out=gram)
+        return gram
+
+    def search(self, x, source, k=None, dis='euclidean', l2=True, rerank=4, block_size=65536):
+        """source为全精度(未归一化)数据库，只读取候选行用于重排"""
+        if dis not in ('euclidean', 'cos'):
+            raise ValueError(f"不支持的距离度量: {dis}")
+        x = np.atleast_2d(np.array(x, dtype=np.float32))
+        if l2 or dis == 'cos':
+            x = l2_normalize(x, copy=False)
+        rows = len(self)
+        shortlist_size = rows if k is None else min(rows, max(int(k), 1) * max(int(rerank), 1))
+
+        # 第一轮: 在压缩编码上分块扫描，保留每个查询的候选
+        best_distances = np.zeros((len(x), 0), dtype=np.float32)
+        best_indices = np.zeros((len(x), 0), dtype=np.int64)
+        running_min = np.full(len(x), np.inf, dtype=np.float32)
+        running_max = np.full(len(x), -np.inf, dtype=np.float32)
+        for start in range(0, rows, block_size):
+            stop = min(start + block_size, rows)
+            distances = self.approximate_distance(x, start, stop, dis)
+            if dis == 'euclidean':
+                np.minimum(running_min, distances.min(axis=1), out=running_min)
+                np.maximum(running_max, distances.max(axis=1), out=running_max)
+            best_indices, best_distances = merge_top_k(
+                best_indices, best_distances, distances, start, shortlist_size)
+
+        # 第二轮: 读取候选的全精度特征计算精确距离后重排
+        indices = []
+        scores = []
+        for query, shortlist in zip(x, best_indices):
+            shortlist = np.sort(shortlist)
+            candidates = np.array(source[shortlist], dtype=np.float32)
+            if l2 or dis == 'cos':
+                candidates = l2_normalize(candidates, copy=False)
+            gram = candidates @ query
+            if dis == 'cos':
+                exact = 1 - gram
+            else:
+                exact = np.sqrt(np.maximum((query * query).sum() + (candidates * candidates).sum(axis=1) - 2 * gram, 0))
+            order = np.argsort(exact, kind='stable')[:k]
+            indices.append(shortlist[order])
+            scores.append(exact[order])
+
+        index = np.vstack(indices)
+        score = np.vstack(scores)
+        if dis == 'euclidean':
+            # 全局最大距离来自第一轮的近似值
+            if score.shape[1]:
+                running_min = np.minimum(running_min, score[:, 0])
+            score = normalize_by_range(score, running_min, running_max)
+        return index, score
@@ -0,0 +1,92 @@
+"""报告用的离屏渲染
+
+每个检索结果单独渲染一张报告分辨率的图片，不再截取界面上当前页的8个结果窗口，
+结果超过一页时报告中的图片也与模型一一对应。
+渲染在进程池中进行，每个工作进程复用一个离屏视图；任务按批提交，结果逐个产出，
+渲染器只保留当前一批图片。调用方边取边写入时内存占用与结果数无关，
+但小结果集的PDF和单张长图报告需要先收集全部图片。
+"""
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from thumbnail_store import init_renderer, worker_display
+
+DEFAULT_BATCH_SIZE = 16
+
+
+def default_workers():
+    return max(1, min(4, (os.cpu_count() or 1) - 1))
+
+
+def capture_png(display, size):
+    """读取离屏视图的帧缓冲并编码为PNG字节"""
+    from OCC.Core.Graphic3d import Graphic3d_BufferType
+    from PIL import Image as PILImage
+
+    width, height = size
+    data = display.GetImageData(width, height, Graphic3d_BufferType.Graphic3d_BT_RGB)
+    # OpenGL帧缓冲的行序自下而上
+    image = PILImage.frombuffer('RGB', (width, height), data, 'raw', 'RGB', len(data) // height, -1)
+    buffer = io.BytesIO()
+    image.save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def render_result(step_path, color, size, level='medium'):
+    """在工作进程中渲染一个结果，返回(PNG字节, 错误信息)"""
+    from OCC.Core.Quantity import Quantity_Color, Quantity_TOC_RGB
+    from brep_cache import brep_cache
+
+    display = worker_display()
+    try:
+        shapes = brep_cache.load(step_path, level, evict=False)
+        display.EraseAll()
+        occ_color = Quantity_Color(color[0], color[1], color[2], Quantity_TOC_RGB)
+        for shape in shapes:
+            display.DisplayColoredShape(shape, color=occ_color, update=False)
+        display.View_Iso()
+        display.FitAll()
+        return capture_png(display, size), None
+    except Exception as e:
+        return None, str(e)
+
+
+class ReportRenderer:
+    """按批渲染[(STEP路径, 颜色)]，颜色为0~1的RGB元组"""
+
+    def __init__(self, size=(800, 600), workers=None, batch_size=DEFAULT_BATCH_SIZE, level='medium'):
+        self.size = tuple(size)
+        self.workers = workers or default_workers()
+        self.batch_size = batch_size
+        self.level = level
+
+    def render(self, items, progress=None):
+        """按输入顺序逐个产出(序号, PNG字节或None, 错误信息)
+
+        progress(已完成数, 总数)在每批完成后调用。
+        """
+        items = list(items)
+        total = len(items)
+        if not total:
+            return
+        if self.workers <= 1:
+            init_renderer(self.size)
+            for start in range(0, total, self.batch_size):
+                for index in range(start, min(start + self.batch_size, total)):
+                    step_path, color = items[index]
+                    yield (index,) + render_result(step_path, color, self.size, self.level)
+                if progress:
+                    progress(min(start + self.batch_size, total), total)
+            return
+
+        with ProcessPoolExecutor(min(self.workers, total), initializer=init_renderer,
+                                 initargs=(self.size,)) as pool:
+            for start in range(0, total, self.batch_size):
+                batch = items[start:start + self.batch_size]
+                results = pool.map(render_result, [item[0] for item in batch], [item[1] for item in batch],
+                                   [self.size] * len(batch), [self.level] * len(batch))
+                for offset, (data, error) in enumerate(results):
+                    yield (start + offset, data, error)
+                if progress:
+                    progress(start + len(batch), total)
@@ -0,0 +1,287 @@
+"""常驻本地检索服务
+
+数据库特征常驻内存，多个客户端(GUI、脚本)共享同一份已归一化的索引。
+几毫秒内到达的同类请求会合并为一次矩阵乘法。
+
+启动:
+    python retrieval_service.py --db database.npy --steps steps/ --port 8765
+只允许检索--db和--allow-db列出的数据库，请求体超过--max-body-mb时拒绝。
+请求:
+    POST /search  {"features": [[...]], "db": "...", "steps": "...", "k": 8}
+    GET  /health
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from similarity_calculator import get_database, map_result_paths
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+SERVICE_ENV = 'CAD_RETRIEVAL_SERVICE'
+DEFAULT_MAX_BODY = 16 * 1024 * 1024
+
+
+class RequestError(ValueError):
+    """返回给客户端的请求错误，status为HTTP状态码"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class SearchRequest:
+    def __init__(self, x, key, future):
+        self.x = x
+        self.key = key
+        self.future = future
+
+
+class MicroBatcher:
+    """收集时间窗口内的请求，按(数据库, 检索参数)分组后批量计算"""
+
+    def __init__(self, batch_window=0.005, max_batch=256):
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.queue = asyncio.Queue()
+        # 计算在单独线程中串行执行，事件循环保持响应
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.stats = {'requests': 0, 'batches': 0}
+
+    async def submit(self, x, key):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put(SearchRequest(x, key, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            groups = {}
+            for request in batch:
+                groups.setdefault(request.key, []).append(request)
+            for key, requests in groups.items():
+                try:
+                    results = await loop.run_in_executor(self.executor, search_group, key, requests)
+                except Exception as e:
+                    for request in requests:
+                        if not request.future.done():
+                            request.future.set_exception(e)
+                    continue
+                for request, result in zip(requests, results):
+                    if not request.future.done():
+                        request.future.set_result(result)
+            self.stats['requests'] += len(batch)
+            self.stats['batches'] += 1
+
+
+def database_dim(database):
+    if database.features is not None:
+        return database.features.shape[1]
+    return database.quantized.codes.shape[1]
+
+
+def search_group(key, requests):
+    # 同一分组的所有查询拼成一个矩阵，只做一次检索；分组键含特征维度，维度错误的请求不会影响其他请求
+    database_input, is_single_file, step_folder, k, dis, nprobe, quantization, dim = key
+    database = get_database(database_input, is_single_file, quantization)
+    if len(database) == 0:
+        return [([], []) for _ in requests]
+    if dim != database_dim(database):
+        raise RequestError(f"查询特征维度为{dim}，数据库特征维度为{database_dim(database)}")
+
+    x = np.vstack([request.x for request in requests])
+    index, score = database.search(x, k, dis, nprobe=nprobe)
+    retrieval_path = database.retrieval_paths(step_folder)
+
+    results = []
+    row = 0
+    for request in requests:
+        rows = len(request.x)
+        paths = []
+        scores = []
+        for i in range(row, row + rows):
+            result_paths, result_scores = map_result_paths(index[i], score[i], retrieval_path)
+            paths.append(result_paths)
+            scores.append(result_scores)
+        results.append((paths, scores))
+        row += rows
+    return results
+
+
+class RetrievalService:
+    def __init__(self, default_db=None, default_steps=None, batch_window=0.005, max_batch=256,
+                 allowed_dbs=(), max_body=DEFAULT_MAX_BODY):
+        self.default_db = default_db
+        self.default_steps = default_steps
+        self.batcher = MicroBatcher(batch_window, max_batch)
+        # 数据库文件可能以allow_pickle方式读取，只允许服务端配置过的路径
+        self.allowed_dbs = {os.path.abspath(path) for path in allowed_dbs}
+        if default_db:
+            self.allowed_dbs.add(os.path.abspath(default_db))
+        self.max_body = max_body
+
+    def request_key(self, payload, dim):
+        database_input = payload.get('db') or self.default_db
+        step_folder = payload.get('steps') or self.default_steps
+        if not database_input or not step_folder:
+            raise ValueError("请求中缺少db或steps，且服务未设置默认值")
+        database_input = os.path.abspath(database_input)
+        if database_input not in self.allowed_dbs:
+            raise RequestError(f"服务未允许检索该数据库: {database_input}", 403)
+        is_single_file = payload.get('is_single_file')
+        if is_single_file is None:
+            is_single_file = not os.path.isdir(database_input)
+        k = payload.get('k')
+        return (database_input, bool(is_single_file), step_folder,
+                None if k is None else int(k), payload.get('dis', 'euclidean'),
+                int(payload.get('nprobe', 8)), payload.get('quantization'), dim)
+
+    async def handle_search(self, payload):
+        # 每个请求在进入队列前单独检查，格式错误只影响该请求
+        x = np.atleast_2d(np.asarray(payload['features'], dtype=np.float32))
+        if x.ndim != 2 or x.size == 0:
+            raise ValueError(f"features应为非空的(N, D)矩阵，实际形状为{x.shape}")
+        if not np.isfinite(x).all():
+            raise ValueError("features中含有NaN或无穷大")
+        start = time.perf_counter()
+        paths, scores = await self.batcher.submit(x, self.request_key(payload, x.shape[1]))
+        return {'paths': paths, 'scores': scores, 'elapsed': time.perf_counter() - start}
+
+    def handle_health(self):
+        return {'status': 'ok', **self.batcher.stats}
+
+    async def handle_connection(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            if not request_line:
+                return
+            method, path, _ = request_line.decode('latin-1').split(' ', 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            length = int(headers.get('content-length', 0))
+            if length < 0:
+                raise ValueError("Content-Length无效")
+            if length > self.max_body:
+                raise RequestError(f"请求体超过上限 {self.max_body} 字节", 413)
+            body = await reader.readexactly(length)
+
+            if method == 'GET' and path == '/health':
+                status, response = 200, self.handle_health()
+            elif method == 'POST' and path == '/search':
+                status, response = 200, await self.handle_search(json.loads(body or b'{}'))
+            else:
+                status, response = 404, {'error': f"未知的请求: {method} {path}"}
+        except RequestError as e:
+            status, response = e.status, {'error': str(e)}
+        except (ValueError, KeyError) as e:
+            status, response = 400, {'error': str(e)}
+        except Exception as e:
+            status, response = 500, {'error': str(e)}
+
+        data = json.dumps(response, ensure_ascii=False).encode('utf-8')
+        reason = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+                  413: 'Payload Too Large'}.get(status, 'Internal Server Error')
+        writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Type: application/json; charset=utf-8\r\n"
+                     f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode('latin-1') + data)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        if self.default_db:
+            # 启动时预热默认数据库
+            get_database(self.default_db, not os.path.isdir(self.default_db))
+        batch_task = asyncio.create_task(self.batcher.run())
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print(f"检索服务已启动: http://{host}:{port}", file=sys.stderr)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batch_task.cancel()
+
+
+class RetrievalClient:
+    """检索服务客户端，接口与process_query一致"""
+
+    def __init__(self, url=None, timeout=60):
+        self.url = (url or os.environ.get(SERVICE_ENV) or f"http://{DEFAULT_HOST}:{DEFAULT_PORT}").rstrip('/')
+        self.timeout = timeout
+
+    def request(self, path, payload=None):
+        data = None if payload is None else json.dumps(payload).encode('utf-8')
+        request = urllib.request.Request(self.url + path, data=data,
+                                         headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read().decode('utf-8'))
+
+    def health(self):
+        return self.request('/health')
+
+    def process_queries(self, x, database_input, folder_path, is_single_file=True, k=None, dis='euclidean',
+                        nprobe=8, quantization=None):
+        response = self.request('/search', {
+            'features': np.atleast_2d(np.asarray(x, dtype=np.float32)).tolist(),
+            'db': os.path.abspath(database_input),
+            'steps': folder_path,
+            'is_single_file': is_single_file,
+            'k': k,
+            'dis': dis,
+            'nprobe': nprobe,
+            'quantization': quantization,
+        })
+        return response['paths'], response['scores']
+
+    def process_query(self, x, database_input, folder_path, is_single_file=True, k=None, dis='euclidean',
+                      nprobe=8, quantization=None):
+        paths, scores = self.process_queries(
+            np.atleast_2d(x)[:1], database_input, folder_path, is_single_file, k, dis, nprobe, quantization)
+        return paths[0], scores[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="常驻本地检索服务")
+    parser.add_argument('--db', default=None, help="默认数据库特征文件或目录(启动时预热)")
+    parser.add_argument('--allow-db', action='append', default=[],
+                        help="允许客户端检索的其他数据库(可重复)，默认只允许--db")
+    parser.add_argument('--steps', default=None, help="默认STEP文件目录")
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--batch-window-ms', type=float, default=5.0, help="合并请求的等待时间(毫秒)")
+    parser.add_argument('--max-batch', type=int, default=256, help="单批最多合并的请求数")
+    parser.add_argument('--max-body-mb', type=float, default=DEFAULT_MAX_BODY / 2 ** 20, help="请求体大小上限(MB)")
+    args = parser.parse_args()
+
+    service = RetrievalService(args.db, args.steps, args.batch_window_ms / 1000, args.max_batch,
+                               args.allow_db, int(args.max_body_mb * 2 ** 20))
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+import os
+import threading
+from collections import OrderedDict
+
+from brep_cache import brep_cache
+
+# set_budget中未传入的上限保持不变，None表示不限制
+_UNCHANGED = object()
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+class ShapeCache:
+    """已解析STEP模型的LRU缓存，按(路径, 细节层次)索引，文件大小或修改时间变化后失效
+
+    模型占用的内存难以直接统计，这里以STEP文件大小近似估计。
+    未命中时通过磁盘上的BRep缓存读取，只有第一次才解析STEP文本。
+    """
+
+    def __init__(self, max_entries=64, max_bytes=512 * 1024 * 1024, loader=brep_cache.load):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.loader = loader
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, path):
+        return self.contains(path)
+
+    def contains(self, path, level=None):
+        key = (os.path.abspath(path), level)
+        try:
+            signature = file_signature(key[0])
+        except OSError:
+            return False
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry is not None and entry[0] == signature
+
+    def get(self, path, level=None):
+        """返回{shape: [name, color]}，文件未变化时直接使用缓存；level为剖分的细节层次"""
+        key = (os.path.abspath(path), level)
+        signature = file_signature(key[0])
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == signature:
+                self.entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return entry[1]
+            self.stats['misses'] += 1
+
+        # 解析在锁外进行，多个线程可以同时读取不同的文件
+        shapes = self.loader(key[0], level)
+        self.put(key, signature, shapes)
+        return shapes
+
+    def put(self, key, signature, shapes):
+        size = signature[0]
+        with self.lock:
+            self.discard(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self.entries[key] = (signature, shapes, size)
+            self.nbytes += size
+            self.evict()
+
+    def discard(self, key):
+        # 调用方需持有锁
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry[2]
+
+    def evict(self):
+        # 调用方需持有锁
+        while self.entries and (
+                (self.max_entries is not None and len(self.entries) > self.max_entries) or
+                (self.max_bytes is not None and self.nbytes > self.max_bytes)):
+            _, (_, _, size) = self.entries.popitem(last=False)
+            self.nbytes -= size
+
+    def set_budget(self, max_entries=_UNCHANGED, max_bytes=_UNCHANGED):
+        """修改缓存上限(未传入的保持原值，传入None表示不限制)，超出部分立即按最近最少使用淘汰"""
+        with self.lock:
+            if max_entries is not _UNCHANGED:
+                self.max_entries = max_entries
+            if max_bytes is not _UNCHANGED:
+                self.max_bytes = max_bytes
+            self.evict()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+
+shape_cache = ShapeCache()
+
+
+def load_step_shapes(path, level=None):
+    return shape_cache.get(path, level)
@@ -1,12 +1,19 @@
 import os
+import threading
+import tracemalloc
+from collections import OrderedDict
 import numpy as np
-import torch
-import torch.nn.functional as F
-from sklearn.metrics.pairwise import euclidean_distances
 
+from feature_store import (open_feature_store, list_feature_files, load_feature_files, read_feature_shapes,
+                           FeatureFileRows)
 
-def l2_normalize(features):
-    features_c = features.copy()
+
+class SearchCancelled(Exception):
+    """进度回调中抛出，用于中止正在进行的检索"""
+
+
+def l2_normalize(features, copy=True):
+    features_c = features.copy() if copy else features
     features_c /= np.sqrt((features_c * features_c).sum(axis=1))[:, None]
     return features_c
 
@@ -18,6 +25,9 @@ def distance_to_similarity(distance):
     similarity = np.clip(similarity, 0, 1)
     return similarity * 100  # 百分比
 def compute_distance(x, y, l2=True):
+    # sklearn导入较慢，只在用到时加载
+    from sklearn.metrics.pairwise import euclidean_distances
+
     if l2:
         x = l2_normalize(x)
         y = l2_normalize(y)
@@ -31,31 +41,165 @@ def compute_distance(x, y, l2=True):
     return normalized_distances
 
 
-def computer_cos(x, y, l2=True):
-    if l2:
-        x = l2_normalize(x)
-        y = l2_normalize(y)
-    x_nor = F.normalize(torch.tensor(x), p=2, dim=1)
-    y_nor = F.normalize(torch.tensor(y), p=2, dim=1)
+def cosine_distance_normalized(x, y, y_scale=None):
+    # x、y均已做L2归一化时，余弦距离只需一次矩阵乘法
+    # y_scale为y各行的缩放系数(未归一化的共享矩阵)，在乘积上按列缩放
+    distances = x @ y.T
+    if y_scale is not None:
+        distances *= y_scale[None, :]
+    np.subtract(1, distances, out=distances)
+    return distances
+
+
+def computer_cos_torch(x, y):
+    # torch只在显式选择该后端时才导入
+    try:
+        import torch
+        import torch.nn.functional as F
+    except ImportError:
+        raise ImportError("torch后端需要安装PyTorch(pip install torch)")
+    x_nor = F.normalize(torch.from_numpy(x), p=2, dim=1)
+    y_nor = F.normalize(torch.from_numpy(y), p=2, dim=1)
     cos = 1 - torch.mm(x_nor, y_nor.t())
     return cos.numpy()
 
 
-def generate_retrival_distance(x, y, l2=True, dis='euclidean'):
+def computer_cos(x, y, l2=True, backend='numpy'):
+    # 余弦距离本身要求单位向量，因此无论l2取值都做归一化
+    x = l2_normalize(np.array(x, dtype=np.float32), copy=False)
+    y = l2_normalize(np.array(y, dtype=np.float32), copy=False)
+    if backend == 'torch':
+        return computer_cos_torch(x, y)
+    if backend != 'numpy':
+        raise ValueError(f"不支持的计算后端: {backend}")
+    return cosine_distance_normalized(x, y)
+
+
+def generate_retrival_distance(x, y, l2=True, dis='euclidean', backend='numpy'):
     if dis == 'euclidean':
         result = compute_distance(x, y, l2)
     elif dis == 'cos':
-        result = computer_cos(x, y, l2)
+        result = computer_cos(x, y, l2, backend)
+    else:
+        raise ValueError(f"不支持的距离度量: {dis}")
     return result
 
 
-def retrieval(x, y):
-    result = generate_retrival_distance(x, y, l2=True, dis='euclidean')
-    sorted_indices = np.argsort(result, axis=1)
-    sorted = np.sort(result, axis=1)
+def select_top_k(result, k=None):
+    # 只需要前k个结果时，先用argpartition做部分选择，再只对这k个候选排序
+    n = result.shape[1]
+    if k is None or k >= n:
+        sorted_indices = np.argsort(result, axis=1)
+    else:
+        k = max(int(k), 1)
+        candidates = np.argpartition(result, k - 1, axis=1)[:, :k]
+        candidate_scores = np.take_along_axis(result, candidates, axis=1)
+        order = np.argsort(candidate_scores, axis=1, kind='stable')
+        sorted_indices = np.take_along_axis(candidates, order, axis=1)
+    sorted = np.take_along_axis(result, sorted_indices, axis=1)
     return sorted_indices, sorted
 
 
+def merge_top_k(best_indices, best_distances, distances, start, k):
+    # 当前保留的前k个与新分块的距离合并后重新选出前k个
+    merged_distances = np.concatenate([best_distances, distances], axis=1)
+    block_indices = np.broadcast_to(np.arange(start, start + distances.shape[1]), distances.shape)
+    merged_indices = np.concatenate([best_indices, block_indices], axis=1)
+    order, best_distances = select_top_k(merged_distances, k)
+    return np.take_along_axis(merged_indices, order, axis=1), best_distances
+
+
+def normalize_by_range(distances, min_distance, max_distance):
+    span = max_distance - min_distance
+    span[span == 0] = 1
+    return (distances - min_distance[:, None]) / span[:, None]
+
+
+def retrieval(x, y, k=None):
+    result = generate_retrival_distance(x, y, l2=True, dis='euclidean')
+    return select_top_k(result, k)
+
+
+def normalize_rows(distances):
+    # 按查询逐行做min-max归一化，与单次查询的结果保持一致
+    min_distance = distances.min(axis=1, keepdims=True)
+    max_distance = distances.max(axis=1, keepdims=True)
+    span = max_distance - min_distance
+    span[span == 0] = 1
+    distances -= min_distance
+    distances /= span
+    return distances
+
+
+def batch_distance(x, y, y_sq, dis='euclidean', y_scale=None):
+    # 一个查询块只做一次矩阵乘法，欧氏距离由 |x|^2 + |y|^2 - 2xy 得到
+    if dis == 'cos':
+        return cosine_distance_normalized(x, y, y_scale)
+    if dis != 'euclidean':
+        raise ValueError(f"不支持的距离度量: {dis}")
+    return normalize_rows(euclidean_gram_distance(x, y, y_sq, y_scale))
+
+
+def euclidean_gram_distance(x, y, y_sq, y_scale=None):
+    # 未归一化的欧氏距离，y_sq为(缩放后)各行的平方范数
+    gram = x @ y.T
+    if y_scale is not None:
+        gram *= y_scale[None, :]
+    x_sq = (x * x).sum(axis=1)
+    gram *= -2
+    gram += x_sq[:, None]
+    gram += y_sq[None, :]
+    np.maximum(gram, 0, out=gram)
+    np.sqrt(gram, out=gram)
+    return gram
+
+
+def chunked_distance(x, y, y_sq, dis, progress, row_block=262144, y_scale=None):
+    # 按数据库行分块计算距离，每块之后回调progress，回调中可抛出SearchCancelled中止
+    if dis not in ('euclidean', 'cos'):
+        raise ValueError(f"不支持的距离度量: {dis}")
+    distances = np.empty((len(x), len(y)), dtype=np.float32)
+    for start in range(0, len(y), row_block):
+        stop = min(start + row_block, len(y))
+        scale = None if y_scale is None else y_scale[start:stop]
+        if dis == 'cos':
+            distances[:, start:stop] = cosine_distance_normalized(x, y[start:stop], scale)
+        else:
+            distances[:, start:stop] = euclidean_gram_distance(x, y[start:stop], y_sq[start:stop], scale)
+        progress('scoring', stop / max(len(y), 1))
+    return normalize_rows(distances) if dis == 'euclidean' else distances
+
+
+def search_normalized(x, y, y_sq, k=None, dis='euclidean', l2=True, block_size=256, progress=None,
+                      y_scale=None):
+    # y为已归一化的数据库矩阵，y_sq为其各行的平方范数
+    # y为未归一化的共享矩阵(内存映射)时，y_scale给出各行的归一化系数
+    x = np.atleast_2d(np.array(x, dtype=np.float32))
+    if l2:
+        x = l2_normalize(x, copy=False)
+
+    indices = []
+    scores = []
+    for start in range(0, len(x), block_size):
+        if progress is None:
+            distances = batch_distance(x[start:start + block_size], y, y_sq, dis, y_scale)
+        else:
+            distances = chunked_distance(x[start:start + block_size], y, y_sq, dis, progress, y_scale=y_scale)
+            progress('ranking', 0)
+        index, score = select_top_k(distances, k)
+        indices.append(index)
+        scores.append(score)
+    return np.vstack(indices), np.vstack(scores)
+
+
+def batch_retrieval(x, y, k=None, dis='euclidean', l2=True, block_size=256):
+    y = np.array(y, dtype=np.float32)
+    if l2:
+        y = l2_normalize(y, copy=False)
+    y_sq = (y * y).sum(axis=1)
+    return search_normalized(x, y, y_sq, k, dis, l2, block_size)
+
+
 def get_file_paths(folder_path):
     file_paths = []
     for item in os.listdir(folder_path):
@@ -66,35 +210,383 @@ def get_file_paths(folder_path):
     return file_paths
 
 
-def load_features_from_folder(folder_path):
-    features = []
-    for item in os.listdir(folder_path):
-        if item.endswith('.npy'):
-            file_path = os.path.join(folder_path, item)
-            feature = np.load(file_path, allow_pickle=True)
-            features.append(feature)
-    return np.vstack(features) if features else np.array([])
+def load_features_from_folder(folder_path, max_workers=None, progress=None):
+    # 按文件名排序，与get_file_paths返回的STEP文件顺序一一对应
+    feature_files = list_feature_files(folder_path)
+    if not feature_files:
+        return np.array([])
+    features, _ = load_feature_files(folder_path, feature_files, max_workers=max_workers, progress=progress)
+    return features
 
 
-def process_query(x, database_input, folder_path, is_single_file=True):
+def source_fingerprint(database_input, is_single_file=True):
+    # 用文件大小和修改时间判断数据库是否变化
     if is_single_file:
-        y = database_input
-    else:
-        y = load_features_from_folder(database_input)
+        st = os.stat(database_input)
+        return st.st_size, st.st_mtime_ns
+    entries = []
+    with os.scandir(database_input) as it:
+        for entry in it:
+            if entry.name.endswith('.npy') and entry.is_file():
+                st = entry.stat()
+                entries.append((entry.name, st.st_size, st.st_mtime_ns))
+    entries.sort()
+    return os.stat(database_input).st_mtime_ns, tuple(entries)
+
+
+class FeatureDatabase:
+    """常驻内存的数据库特征，归一化结果在多次检索之间复用"""
+
+    def __init__(self, database_input=None, is_single_file=True, l2=True, quantization=None, rerank=4):
+        self.database_input = database_input
+        self.is_single_file = is_single_file
+        self.l2 = l2
+        self.quantization = quantization
+        self.rerank = rerank
+        self.fingerprint = None
+        self.features = None
+        self.sq_norms = None
+        self.row_scale = None
+        self.quantized = None
+        self.source = None
+        self.rows = 0
+        self.store = None
+        self.ivf = None
+        self.path_cache = {}
+
+    @classmethod
+    def from_array(cls, features, l2=True, quantization=None):
+        database = cls(l2=l2, quantization=quantization)
+        database.set_features(features)
+        return database
+
+    def set_features(self, features, store=None):
+        if not isinstance(features, FeatureFileRows):
+            features = np.asarray(features)
+            if features.size == 0:
+                features = np.zeros((0, 0), dtype=np.float32)
+        self.rows = len(features)
+        self.store = store
+        self.ivf = None
+        self.path_cache = {}
+
+        if self.quantization and self.rows:
+            # 量化模式只常驻压缩编码，全精度数据为内存映射(单文件、打包特征库)或按文件读取的目录，
+            # 仅在重排时读取候选行
+            from quantization import QuantizedMatrix
+            self.quantized = QuantizedMatrix.build(features, self.quantization, self.l2)
+            self.source = features
+            self.features = None
+            self.sq_norms = None
+            return
+
+        self.quantized = None
+        self.source = None
+        self.row_scale = None
+        if features.dtype != np.float32:
+            # 转换类型得到的是私有副本，可以原地归一化
+            features = features.astype(np.float32)
+            if self.l2 and len(features):
+                features = l2_normalize(features, copy=False)
+        elif self.l2 and len(features):
+            # 已是float32(通常为打包特征库的内存映射)时不复制，多个进程共享同一份页缓存；
+            # 归一化改为在距离计算时按行缩放
+            norms = np.sqrt(np.einsum('ij,ij->i', features, features))
+            norms[norms == 0] = 1
+            self.row_scale = (1 / norms).astype(np.float32)
+        self.features = features
+        sq_norms = np.einsum('ij,ij->i', features, features)
+        self.sq_norms = sq_norms if self.row_scale is None else sq_norms * self.row_scale * self.row_scale
+
+    def dense_features(self):
+        """归一化后的float32矩阵，量化模式或按行缩放时临时生成"""
+        if self.features is not None and self.row_scale is None:
+            return self.features
+        if self.features is not None:
+            return self.features * self.row_scale[:, None]
+        features = np.array(self.source[:], dtype=np.float32)
+        return l2_normalize(features, copy=False) if self.l2 else features
+
+    @property
+    def nbytes(self):
+        if self.quantized is not None:
+            return self.quantized.nbytes
+        return 0 if self.features is None else self.features.nbytes + self.sq_norms.nbytes
 
-    if len(y) == 0:
+    def is_stale(self):
+        if self.database_input is None:
+            return False
+        return self.fingerprint != source_fingerprint(self.database_input, self.is_single_file)
+
+    def refresh(self, progress=None):
+        """源文件或目录发生变化时重新加载，返回是否重新加载"""
+        loaded = self.features is not None or self.quantized is not None
+        if self.database_input is None or (loaded and not self.is_stale()):
+            return False
+        if progress:
+            progress('loading', 0)
+        # 先释放旧数据的内存映射，Windows下被映射的文件无法被覆盖或删除
+        self.close()
+        fingerprint = source_fingerprint(self.database_input, self.is_single_file)
+        if self.is_single_file:
+            # 单个数据库文件读入内存，不长期映射，外部程序可以随时覆盖；
+            # 量化模式只常驻编码，全精度数据仍以内存映射方式读取候选行
+            self.set_features(load_database_file(self.database_input, mmap=bool(self.quantization)))
+        else:
+            store = open_feature_store(self.database_input)
+            if store is not None:
+                self.set_features(store.features, store)
+            elif self.quantization and list_feature_files(self.database_input):
+                # 编码后不保留全精度矩阵，重排时从各特征文件读取候选行
+                self.set_features(FeatureFileRows(self.database_input))
+            else:
+                self.set_features(load_features_from_folder(self.database_input, progress=progress))
+        self.fingerprint = fingerprint
+        if progress:
+            progress('loading', 1)
+        return True
+
+    def close(self):
+        """释放特征矩阵、打包特征库和IVF索引的引用，最后一个引用释放后内存映射随之关闭"""
+        self.features = None
+        self.sq_norms = None
+        self.row_scale = None
+        self.quantized = None
+        self.source = None
+        self.store = None
+        self.ivf = None
+        self.rows = 0
+        self.fingerprint = None
+        self.path_cache = {}
+
+    def __len__(self):
+        return self.rows
+
+    def get_ivf_index(self, progress=None):
+        """IVF近似索引，首次使用时加载或训练"""
+        if self.ivf is None:
+            from ivf_index import load_saved_ivf_index, build_ivf_index
+            # 先按行数和指纹查找已保存的索引，只有需要重新训练时才生成归一化的全精度矩阵
+            self.ivf = load_saved_ivf_index(self.database_input, self.fingerprint, len(self))
+            if self.ivf is None:
+                self.ivf = build_ivf_index(self.dense_features(), self.database_input, self.fingerprint,
+                                           progress=progress)
+        return self.ivf
+
+    def search(self, x, k=None, dis='euclidean', block_size=256, nprobe=8, progress=None):
+        if dis == 'ivf' or self.quantized is not None:
+            if progress:
+                progress('scoring', 0)
+            if dis == 'ivf':
+                result = self.get_ivf_index(progress).search(x, k, nprobe, l2=self.l2)
+            else:
+                result = self.quantized.search(x, self.source, k, dis, self.l2, self.rerank)
+            if progress:
+                progress('ranking', 1)
+            return result
+        return search_normalized(x, self.features, self.sq_norms, k, dis, self.l2, block_size, progress,
+                                 self.row_scale)
+
+    def retrieval_paths(self, folder_path):
+        # STEP目录未变化(修改时间相同)时复用上次的文件列表
+        key = (folder_path, self.store is not None)
+        mtime = os.stat(folder_path).st_mtime_ns
+        cached = self.path_cache.get(key)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, get_retrieval_paths(folder_path, self.store))
+            self.path_cache[key] = cached
+        return cached[1]
+
+
+_database_cache = OrderedDict()
+_database_lock = threading.RLock()
+max_cached_databases = 2
+
+
+def load_database_file(file_path, mmap=False):
+    if mmap:
+        try:
+            return np.load(file_path, mmap_mode='r')
+        except ValueError:
+            # 含Python对象的文件无法内存映射
+            pass
+    return np.load(file_path, allow_pickle=True)
+
+
+def get_database(database_input, is_single_file=True, quantization=None, progress=None):
+    """获取常驻数据库，已缓存且未变化时直接复用"""
+    if not isinstance(database_input, (str, os.PathLike)):
+        return FeatureDatabase.from_array(database_input, quantization=quantization)
+
+    key = (os.path.abspath(database_input), is_single_file, quantization)
+    # 界面线程、后台检索线程和服务可能同时访问缓存
+    with _database_lock:
+        database = _database_cache.pop(key, None)
+        if database is None:
+            database = FeatureDatabase(database_input, is_single_file, quantization=quantization)
+        try:
+            database.refresh(progress)
+        finally:
+            if database.fingerprint is not None:
+                _database_cache[key] = database
+        while len(_database_cache) > max_cached_databases:
+            _database_cache.popitem(last=False)
+    return database
+
+
+def clear_database_cache():
+    with _database_lock:
+        _database_cache.clear()
+
+
+def get_retrieval_paths(folder_path, store=None):
+    if store is not None:
+        step_paths = store.step_paths(folder_path)
+        if step_paths is not None:
+            return step_paths
+    return get_file_paths(folder_path)
+
+
+def process_query(x, database_input, folder_path, is_single_file=True, k=None, dis='euclidean', nprobe=8,
+                  quantization=None, progress=None):
+    """progress(stage, fraction)在加载、计算距离、排序各阶段回调"""
+    database = get_database(database_input, is_single_file, quantization, progress)
+
+    if len(database) == 0:
         return [], []
 
-    index, score = retrieval(x, y)
-    retrieval_path = get_file_paths(folder_path)
+    index, score = database.search(x, k, dis, nprobe=nprobe, progress=progress)
+    retrieval_path = database.retrieval_paths(folder_path)
+    return map_result_paths(index[0], score[0], retrieval_path)
+
+
+def map_result_paths(index, score, retrieval_path):
     result_paths = []
     result_scores = []
 
-
-    for i in range(len(retrieval_path)):
-        path = retrieval_path[index[0][i]]
-        sim_percent = distance_to_similarity(score[0][i])
+    for i in range(min(len(retrieval_path), len(index))):
+        path = retrieval_path[index[i]]
+        sim_percent = distance_to_similarity(score[i])
         result_paths.append(path)
         result_scores.append(float(sim_percent))
 
-    return result_paths, result_scores
\ No newline at end of file
+    return result_paths, result_scores
+
+
+def process_queries(x, database_input, folder_path, is_single_file=True, k=None,
+                    dis='euclidean', block_size=256, nprobe=8, quantization=None):
+    """批量检索: x为(Q, D)查询矩阵，返回每个查询的结果路径和得分列表"""
+    database = get_database(database_input, is_single_file, quantization)
+
+    if len(database) == 0:
+        return [[] for _ in range(len(x))], [[] for _ in range(len(x))]
+
+    index, score = database.search(x, k, dis, block_size, nprobe)
+    retrieval_path = database.retrieval_paths(folder_path)
+    all_paths = []
+    all_scores = []
+    for row_index, row_score in zip(index, score):
+        result_paths, result_scores = map_result_paths(row_index, row_score, retrieval_path)
+        all_paths.append(result_paths)
+        all_scores.append(result_scores)
+
+    return all_paths, all_scores
+
+
+def iter_database_blocks(database_input, is_single_file=True, block_size=65536):
+    """按固定行数分块读取数据库，返回(分块生成器, 打包特征库)"""
+    store = None
+    if is_single_file:
+        source = load_database_file(database_input, mmap=True)
+    else:
+        store = open_feature_store(database_input)
+        source = store.features if store is not None else None
+
+    def blocks():
+        if source is not None:
+            for start in range(0, len(source), block_size):
+                yield start, source[start:start + block_size]
+            return
+
+        # 未打包的目录按文件头把特征文件分组，每组并行读取为一个分块
+        feature_files = list_feature_files(database_input)
+        shapes = read_feature_shapes(database_input, feature_files)
+        group = []
+        group_rows = 0
+        start = 0
+        for item, shape in zip(feature_files, shapes):
+            group.append(item)
+            group_rows += shape[0]
+            if group_rows >= block_size:
+                yield start, load_feature_files(database_input, group)[0]
+                start += group_rows
+                group = []
+                group_rows = 0
+        if group:
+            yield start, load_feature_files(database_input, group)[0]
+
+    return blocks(), store
+
+
+def stream_retrieval(x, database_input, is_single_file=True, k=8, dis='euclidean', l2=True,
+                     block_size=65536, report_memory=False):
+    """分块流式检索: 每块计算距离后与当前前k个结果合并，峰值内存与数据库大小无关"""
+    if k is None:
+        raise ValueError("流式检索需要指定返回结果数k")
+    if dis not in ('euclidean', 'cos'):
+        raise ValueError(f"不支持的距离度量: {dis}")
+
+    if report_memory:
+        tracemalloc.start()
+    try:
+        x = np.atleast_2d(np.array(x, dtype=np.float32))
+        if l2 or dis == 'cos':
+            x = l2_normalize(x, copy=False)
+
+        best_distances = np.zeros((len(x), 0), dtype=np.float32)
+        best_indices = np.zeros((len(x), 0), dtype=np.int64)
+        running_min = np.full(len(x), np.inf, dtype=np.float32)
+        running_max = np.full(len(x), -np.inf, dtype=np.float32)
+        rows = 0
+        block_count = 0
+
+        blocks, store = iter_database_blocks(database_input, is_single_file, block_size)
+        for start, block in blocks:
+            block = np.array(block, dtype=np.float32)
+            if l2 or dis == 'cos':
+                block = l2_normalize(block, copy=False)
+            if dis == 'cos':
+                distances = cosine_distance_normalized(x, block)
+            else:
+                distances = euclidean_gram_distance(x, block, (block * block).sum(axis=1))
+                # 归一化需要全局最小/最大距离，逐块累计
+                np.minimum(running_min, distances.min(axis=1), out=running_min)
+                np.maximum(running_max, distances.max(axis=1), out=running_max)
+
+            best_indices, best_distances = merge_top_k(best_indices, best_distances, distances, start, k)
+
+            rows += len(block)
+            block_count += 1
+
+        if dis == 'euclidean' and rows:
+            best_distances = normalize_by_range(best_distances, running_min, running_max)
+
+        stats = {'rows': rows, 'blocks': block_count, 'block_size': block_size}
+        if report_memory:
+            stats['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        return best_indices, best_distances, store, stats
+    finally:
+        if report_memory:
+            tracemalloc.stop()
+
+
+def process_query_streaming(x, database_input, folder_path, is_single_file=True, k=8, dis='euclidean',
+                            block_size=65536, report_memory=False):
+    """流式版本的process_query，额外返回分块和峰值内存统计"""
+    index, score, store, stats = stream_retrieval(
+        x, database_input, is_single_file, k, dis, block_size=block_size, report_memory=report_memory)
+    if stats['rows'] == 0:
+        return [], [], stats
+    retrieval_path = get_retrieval_paths(folder_path, store)
+    result_paths, result_scores = map_result_paths(index[0], score[0], retrieval_path)
+    return result_paths, result_scores, stats
\ No newline at end of file
@@ -0,0 +1,78 @@
+"""启动耗时分析: python main.py --profile-startup
+
+统计每个模块第一次导入的耗时(自身/含子模块)和各初始化阶段的耗时。
+打包后的程序没有控制台，结果同时写入 ~/cad_temp/startup_profile.txt。
+"""
+import os
+import sys
+import time
+import builtins
+from contextlib import contextmanager
+
+
+class StartupProfiler:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.imports = {}
+        self.stages = []
+        self.stack = []
+        self.original_import = None
+
+    def install(self):
+        self.original_import = builtins.__import__
+        builtins.__import__ = self.timed_import
+
+    def uninstall(self):
+        if self.original_import is not None:
+            builtins.__import__ = self.original_import
+            self.original_import = None
+
+    def timed_import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        # 只统计第一次导入，已加载的模块直接返回
+        if level or name in sys.modules:
+            return self.original_import(name, globals, locals, fromlist, level)
+        self.stack.append(0.0)
+        begin = time.perf_counter()
+        try:
+            return self.original_import(name, globals, locals, fromlist, level)
+        finally:
+            total = time.perf_counter() - begin
+            children = self.stack.pop()
+            if self.stack:
+                self.stack[-1] += total
+            if name not in self.imports:
+                self.imports[name] = (total - children, total, len(self.stack))
+
+    @contextmanager
+    def stage(self, name):
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages.append((name, time.perf_counter() - begin))
+
+    def report(self, limit=30):
+        elapsed = time.perf_counter() - self.start
+        lines = [f"启动总耗时: {elapsed * 1000:.1f} ms", "", "初始化阶段:"]
+        for name, seconds in self.stages:
+            lines.append(f"  {seconds * 1000:9.1f} ms  {name}")
+
+        lines += ["", f"模块导入(按含子模块耗时排序，前{limit}个):",
+                  f"  {'自身(ms)':>10} {'累计(ms)':>10}  模块"]
+        ranked = sorted(self.imports.items(), key=lambda item: item[1][1], reverse=True)
+        for name, (own, total, depth) in ranked[:limit]:
+            lines.append(f"  {own * 1000:10.1f} {total * 1000:10.1f}  {'  ' * depth}{name}")
+        return '\n'.join(lines)
+
+    def write_report(self, path=None):
+        text = self.report()
+        if sys.stderr is not None:
+            print(text, file=sys.stderr)
+        path = path or os.path.join(os.path.expanduser("~"), "cad_temp", "startup_profile.txt")
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(text + '\n')
+        except OSError:
+            pass
+        return path
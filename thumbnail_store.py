@@ -0,0 +1,228 @@
+"""模型缩略图的离线批量渲染
+
+按STEP文件内容的哈希保存缩略图，同一模型在不同路径下共用一份；
+文件变化后哈希改变，重新运行时只渲染新增或修改过的模型。
+
+用法:
+    python thumbnail_store.py render steps/ --workers 4 --size 400 300
+"""
+import os
+import sys
+import json
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from similarity_calculator import get_file_paths
+
+INDEX_FILE = 'index.json'
+# 与界面中匹配/不匹配的默认颜色一致
+DEFAULT_COLORS = ((0.0, 1.0, 0.0), (1.0, 0.0, 0.0))
+DEFAULT_SIZE = (400, 300)
+
+_worker_renderer = {}
+
+
+def default_store_dir():
+    return os.path.join(os.path.expanduser("~"), "cad_temp", "thumbnails")
+
+
+def content_digest(path, chunk_size=1024 * 1024):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def color_key(color):
+    return ''.join(f"{int(round(c * 255)):02x}" for c in color)
+
+
+def parse_color(text):
+    text = text.lstrip('#')
+    if len(text) != 6:
+        raise argparse.ArgumentTypeError(f"颜色格式应为rrggbb: {text}")
+    return tuple(int(text[i:i + 2], 16) / 255 for i in (0, 2, 4))
+
+
+class ThumbnailStore:
+    """内容寻址的缩略图库: <哈希前两位>/<哈希>_<颜色>_<宽>x<高>.png
+
+    index.json记录每个STEP文件(路径、大小、修改时间)对应的内容哈希，文件未变化时不必重新计算。
+    """
+
+    def __init__(self, store_dir=None, size=DEFAULT_SIZE):
+        self.store_dir = store_dir or default_store_dir()
+        self.size = tuple(size)
+        self.index = None
+
+    def load_index(self):
+        if self.index is None:
+            try:
+                with open(os.path.join(self.store_dir, INDEX_FILE), 'r', encoding='utf-8') as f:
+                    self.index = json.load(f)
+            except (OSError, ValueError):
+                self.index = {}
+        return self.index
+
+    def save_index(self):
+        os.makedirs(self.store_dir, exist_ok=True)
+        index_path = os.path.join(self.store_dir, INDEX_FILE)
+        with open(index_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(self.load_index(), f, ensure_ascii=False)
+        os.replace(index_path + '.tmp', index_path)
+
+    def digest(self, step_path):
+        """返回文件内容哈希，大小和修改时间未变化时直接使用索引中的记录"""
+        step_path = os.path.abspath(step_path)
+        stat = os.stat(step_path)
+        index = self.load_index()
+        entry = index.get(step_path)
+        if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            return entry[2]
+        digest = content_digest(step_path)
+        index[step_path] = [stat.st_size, stat.st_mtime_ns, digest]
+        return digest
+
+    def thumbnail_path(self, digest, color):
+        name = f"{digest}_{color_key(color)}_{self.size[0]}x{self.size[1]}.png"
+        return os.path.join(self.store_dir, digest[:2], name)
+
+    def lookup(self, step_path, color):
+        """返回已渲染的缩略图路径，不存在时返回None"""
+        try:
+            path = self.thumbnail_path(self.digest(step_path), color)
+        except OSError:
+            return None
+        return path if os.path.isfile(path) else None
+
+    def missing(self, step_paths, colors):
+        """返回[(STEP路径, [(颜色, 缩略图路径)])]，只包含还没有渲染的颜色"""
+        tasks = []
+        for step_path in step_paths:
+            digest = self.digest(step_path)
+            outputs = [(tuple(color), self.thumbnail_path(digest, color)) for color in colors]
+            outputs = [output for output in outputs if not os.path.isfile(output[1])]
+            if outputs:
+                tasks.append((step_path, outputs))
+        return tasks
+
+    def render_folder(self, folder_path, colors=DEFAULT_COLORS, workers=1, log=print):
+        """渲染目录下所有STEP文件的缩略图，已有的跳过，返回(渲染数, 跳过数, 失败数)"""
+        step_paths = get_file_paths(folder_path)
+        # 删除目录中已不存在的文件的索引记录
+        folder = os.path.abspath(folder_path) + os.sep
+        index = self.load_index()
+        current = {os.path.abspath(path) for path in step_paths}
+        for path in [path for path in index if path.startswith(folder) and path not in current]:
+            del index[path]
+
+        tasks = self.missing(step_paths, colors)
+        self.save_index()
+        rendered = failed = 0
+        if workers <= 1:
+            init_renderer(self.size)
+            results = (render_thumbnails(*task) for task in tasks)
+            rendered, failed = self.collect(results, rendered, failed, log)
+        else:
+            with ProcessPoolExecutor(workers, initializer=init_renderer, initargs=(self.size,)) as pool:
+                results = pool.map(render_thumbnails, *zip(*tasks)) if tasks else []
+                rendered, failed = self.collect(results, rendered, failed, log)
+
+        skipped = len(step_paths) - len(tasks)
+        log(f"缩略图渲染完成: 新渲染 {rendered} 个模型, 跳过 {skipped} 个, 失败 {failed} 个")
+        return rendered, skipped, failed
+
+    def collect(self, results, rendered, failed, log):
+        for step_path, error in results:
+            if error is None:
+                rendered += 1
+            else:
+                failed += 1
+                log(f"渲染失败 {step_path}: {error}")
+        return rendered, failed
+
+    def prune(self):
+        """删除不再被任何STEP文件引用的缩略图，返回删除数"""
+        digests = {entry[2] for entry in self.load_index().values()}
+        removed = 0
+        if not os.path.isdir(self.store_dir):
+            return removed
+        for prefix in os.listdir(self.store_dir):
+            prefix_dir = os.path.join(self.store_dir, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for item in os.listdir(prefix_dir):
+                if item.endswith('.png') and item.split('_', 1)[0] not in digests:
+                    os.remove(os.path.join(prefix_dir, item))
+                    removed += 1
+        return removed
+
+
+def init_renderer(size):
+    # 每个工作进程创建一个离屏视图，之后的模型复用同一视图
+    from OCC.Display.OCCViewer import OffscreenRenderer
+
+    display = OffscreenRenderer(screen_size=size)
+    display.set_bg_gradient_color([255, 255, 255], [255, 255, 255])
+    display.View.TriedronErase()
+    display.Context.DefaultDrawer().SetAutoTriangulation(False)
+    _worker_renderer['display'] = display
+
+
+def worker_display():
+    return _worker_renderer['display']
+
+
+def render_thumbnails(step_path, outputs):
+    """固定等轴测视角，按每种颜色各渲染一张"""
+    from OCC.Core.Quantity import Quantity_Color, Quantity_TOC_RGB
+    from brep_cache import brep_cache
+
+    display = worker_display()
+    try:
+        shapes = brep_cache.load(step_path, 'medium', evict=False)
+        for color, out_path in outputs:
+            display.EraseAll()
+            occ_color = Quantity_Color(color[0], color[1], color[2], Quantity_TOC_RGB)
+            for shape in shapes:
+                display.DisplayColoredShape(shape, color=occ_color, update=False)
+            display.View_Iso()
+            display.FitAll()
+            os.makedirs(os.path.dirname(out_path), exist_ok=True)
+            tmp_path = out_path[:-len('.png')] + '.tmp.png'
+            display.View.Dump(tmp_path)
+            os.replace(tmp_path, out_path)
+    except Exception as e:
+        return step_path, str(e)
+    return step_path, None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="模型缩略图离线渲染")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    render = subparsers.add_parser('render', help="渲染目录下所有STEP文件的缩略图")
+    render.add_argument('folder', help="STEP文件目录")
+    render.add_argument('--workers', type=int, default=1, help="并行进程数")
+    render.add_argument('--colors', nargs='+', type=parse_color, default=list(DEFAULT_COLORS),
+                        help="渲染颜色(rrggbb)，默认绿色(匹配)和红色(不匹配)")
+
+    subparsers.add_parser('prune', help="删除不再被引用的缩略图")
+
+    for subparser in subparsers.choices.values():
+        subparser.add_argument('--store-dir', default=None, help="缩略图目录，默认 ~/cad_temp/thumbnails")
+        subparser.add_argument('--size', nargs=2, type=int, default=list(DEFAULT_SIZE), metavar=('W', 'H'))
+    args = parser.parse_args(argv)
+
+    store = ThumbnailStore(args.store_dir, args.size)
+    if args.command == 'render':
+        store.render_folder(args.folder, args.colors, args.workers)
+    elif args.command == 'prune':
+        print(f"已删除 {store.prune()} 张缩略图", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())